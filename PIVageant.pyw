@@ -18,26 +18,54 @@
 
 from functools import partial
 from ctypes import windll
+from threading import Thread
 import os
 import sys
+from lib.gui.getwin import check_pageant_running, warn_pageant_running
+
+if __name__ == "__main__":
+    # Checked first, nothing more is loaded when a Pageant is running
+    if check_pageant_running():
+        warn_pageant_running()
+        sys.exit()
+    # The Pageant clients are answered from now, in the Pageant window
+    # thread, while the GUI loads. The keys are listed once read from
+    # the devices, the GUI sets the agent up when it is ready.
+    from lib.agent.core import AgentCore
+    from lib.agent.identities import IdentityRegistry
+    from lib.gui.pageant_win import start_window_thread
+
+    PAGEANT_AGENT = AgentCore(IdentityRegistry("ECPSSHKey"))
+    start_window_thread(PAGEANT_AGENT.dispatch)
+
 import wx
 import wx.lib.newevent
 import lib.gui.mainwin
 import lib.gui.pageant_win
-from lib.gui.getwin import check_pageant_running
 from lib.gui.systemtray import PIVagTray
 from lib.piv.piv_card import (
+    PIVBaseException,
     PIVCardException,
     PIVCardTimeoutException,
     ConnectionException,
+    DataException,
 )
-from lib.piv.genkeys import generate_key
-from lib.ssh.ssh_encodings import openssh_to_wire
-from lib.pageantclient import process_command, read_pubkey
+from lib.piv.card_monitor import PIVCardMonitor
+from lib.piv.card_session import get_session, set_connection_mode
+from lib.piv.device_profiles import device_profiles, DEFAULT_PROFILES_FILE
+from lib.piv.keepalive import CardKeepalive
+from lib.metrics import metrics, SnapshotWriter
 from _version import __version__
 
 KEY_NAME = "ECPSSHKey"
 
+# Touch policy choices of the new key, on Yubico devices
+TOUCH_CHOICES = [
+    ("always", "Touch for each signature"),
+    ("cached", "Touch valid 15 seconds, for many signatures"),
+    ("never", "No touch, signatures without confirmation"),
+]
+
 
 def is_tty():
     if not hasattr(sys, "stdin"):
@@ -48,6 +76,13 @@ def is_tty():
 
 
 DEBUG_OUTPUT = False
+METRICS_FILE = ""
+# Keepalive interval in seconds, disabled when 0
+KEEPALIVE = 0
+# Keepalive stops after this idle time in seconds
+KEEPALIVE_MAX_IDLE = 3600
+# Devices facts and keys cache, disabled with --no-profiles
+PROFILES_FILE = DEFAULT_PROFILES_FILE
 
 
 class ModalWait(lib.gui.mainwin.ModalDialog):
@@ -79,7 +114,8 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
 
     def refresh_key(self, evt):
         evt.Skip()
-        self.waiting_for_pivkey("start")
+        # The keys are read again from the device, not from the caches
+        self.waiting_for_pivkey("start", forget_keys=True)
 
     def gen_key(self, evt):
         evt.Skip()
@@ -94,39 +130,70 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
         )
         confirm_modal.SetYesNoLabels("Proceed", "cancel")
         if confirm_modal.ShowModal() == wx.ID_YES:
+            policy_modal = wx.SingleChoiceDialog(
+                self,
+                "Touch policy of the new key (on Yubico devices)",
+                "Key touch policy",
+                [choice_text for _, choice_text in TOUCH_CHOICES],
+            )
+            if policy_modal.ShowModal() != wx.ID_OK:
+                self.gen_btn.Enable()
+                return
+            touch_policy = TOUCH_CHOICES[policy_modal.GetSelection()][0]
             self.refresh_btn.Disable()
             self.cpy_btn.Disable()
             self.change_status("Key generation ...")
             self.print_pubkey("")
-            res_gen = generate_key(DEBUG_OUTPUT)
-            if res_gen == "done":
-                self.waiting_for_pivkey("genkey")
-            else:
-                self.change_status(res_gen)
+            self.print_policy(None)
+            Thread(
+                target=self.generate,
+                args=(self.reader, touch_policy),
+                name="genkey",
+                daemon=True,
+            ).start()
         else:
             self.gen_btn.Enable()
 
+    def generate(self, reader, touch_policy):
+        # In a worker thread, as the card reads : the GUI thread also pumps
+        # the Pageant messages, and the card can be busy with a signature
+        # Imported here, only needed for a key generation
+        from lib.piv.genkeys import generate_key
+
+        try:
+            res_gen = generate_key(DEBUG_OUTPUT, reader, touch_policy)
+        except PIVBaseException as exc:
+            res_gen = f"Error: {exc}"
+        if res_gen == "done":
+            wx.CallAfter(self.waiting_for_pivkey, "genkey")
+        else:
+            wx.CallAfter(self.change_status, res_gen)
+            wx.CallAfter(self.gen_btn.Enable)
+
     def go_start(self, ssh_pubkey, close):
         self.print_pubkey(ssh_pubkey)
-        process_cb = partial(
-            process_command,
-            DEBUG_OUTPUT,
-            openssh_to_wire(ssh_pubkey),
-            self.sign_status,
-            self.end_status,
-        )
         if close:
             self.change_status("Key read, closing to tray")
-        close_agentwindow()
         self.refresh_btn.Enable()
         self.cpy_btn.Enable()
-        wx.CallLater(500, lib.gui.pageant_win.MainWin, process_cb)
+        # Keys in the other slots are served when found,
+        # and the displayed key is checked when it was from the device profile
+        self.discover_keys()
+
+    def discover_keys(self, reader=None):
+        reader = reader or self.reader
+        self.identities.start_discovery(get_session(DEBUG_OUTPUT, reader))
 
     def change_status(self, text_status):
         self.status_text.SetLabelText(text_status)
 
     def sign_status(self, user, card_info):
         self.change_status("Signature requested")
+        # Devices in different readers can sign at the same time
+        self.signs_pending += 1
+        if self.signs_pending > 1:
+            self.sign_alert.username_txt.SetLabel(f"as user : {user}")
+            return
         self.sign_alert = ModalWait(self)
         if not card_info["isYubico"]:
             self.sign_alert.static_text_modal.SetLabel("Signing with the PIV dongle")
@@ -140,6 +207,9 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
 
     def end_status(self, data_text):
         self.change_status(data_text)
+        self.signs_pending -= 1
+        if self.signs_pending > 0:
+            return
         # save main windows status for selective hide
         is_disp = self.IsShownOnScreen()
         if not is_disp:
@@ -155,6 +225,13 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
     def print_pubkey(self, pubkey_value):
         self.pubkey_text.SetValue(pubkey_value)
 
+    def print_policy(self, policy):
+        """Display the key policies, when known"""
+        label = "Public Key"
+        if policy:
+            label += f"   (touch {policy['touch']}, PIN {policy['pin']})"
+        self.m_staticText4.SetLabel(label)
+
     def get_event(self, event):
         # Process PIVkey events
         if event.type == "Connected":
@@ -166,8 +243,47 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
             self.go_start(event.data, False)
             wx.CallLater(250, self.change_status, "New key generated")
             return
+        if event.type == "Inserted":
+            if (
+                self.reader is not None
+                and self.reader != event.data
+                and self.card_monitor.is_present(self.reader)
+            ):
+                # Keys already served, adds the keys of this device
+                self.identities.start_discovery(get_session(DEBUG_OUTPUT, event.data))
+                self.change_status("PIV device added")
+                return
+            self.reader = event.data
+            self.get_pubkey("start")
+            return
+        if event.type == "Removed":
+            # The keys are still listed, their signatures fail right away
+            # until the device is inserted again
+            self.identities.stop_discovery(event.data)
+            # Waits for the session lock, out of the GUI thread
+            Thread(
+                target=get_session(DEBUG_OUTPUT, event.data).close, daemon=True
+            ).start()
+            if event.data != self.reader:
+                self.change_status("PIV device removed")
+                return
+            remaining_keys = [
+                identity
+                for identity in self.identities.list()
+                if self.card_monitor.is_present(identity.reader)
+            ]
+            if remaining_keys:
+                # Displays a key of another device
+                self.reader = remaining_keys[0].reader
+                self.print_pubkey(remaining_keys[0].openssh())
+                self.print_policy(None)
+                self.change_status("PIV key removed, other device keys served")
+                return
+            self.gen_btn.Disable()
+            self.change_status("PIV key removed, connect a PIV device")
+            return
         if event.type == "Timeout":
-            self.waiting_for_pivkey("start")
+            self.change_status("Connect a PIV device")
             return
         if event.type == "Error":
             self.change_status(event.data)
@@ -176,22 +292,60 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
     def sendtray(self, _):
         wx.CallLater(400, self.Hide)
 
+    def card_inserted(self, reader):
+        wx.PostEvent(self, PivKeyEvent(type="Inserted", data=reader))
+
+    def card_removed(self, reader):
+        wx.PostEvent(self, PivKeyEvent(type="Removed", data=reader))
+
     def closing(self, event):
+        self.card_monitor.stop()
         close_agentwindow()
+        self.agent.close()
         self.trayicon.RemoveIcon()
         self.trayicon.Destroy()
         if hasattr(event, "Skip"):
             event.Skip()
 
-    def waiting_for_pivkey(self, caller):
-        wx.CallLater(500, self.get_pubkey, caller)
-
-    def get_pubkey(self, caller):
+    def waiting_for_pivkey(self, caller, forget_keys=False):
+        wx.CallLater(500, self.get_pubkey, caller, forget_keys)
+
+    def get_pubkey(self, caller, forget_keys=False):
+        """Read the device key in a worker thread
+
+        The GUI thread also pumps the Pageant messages, it never waits for
+        the card session, held by a signature waiting for a touch.
+        """
+        Thread(
+            target=self.read_pubkey,
+            args=(self.reader, caller, forget_keys),
+            name="pubkey",
+            daemon=True,
+        ).start()
+
+    def read_pubkey(self, reader, caller, forget_keys):
+        # The results are posted to the GUI thread
+        session = get_session(DEBUG_OUTPUT, reader)
+        if forget_keys:
+            try:
+                session.run(0.8, lambda card: card.forget_keys())
+            except PIVBaseException:
+                # No device, reported by the key read
+                pass
+        self.identities.remove_reader(reader)
         try:
-            piv_ssh_public_key = read_pubkey(KEY_NAME, 0.8, DEBUG_OUTPUT)
-            self.gen_btn.Enable()
+            # Card Authentication key, the one generated
+            piv_ssh_public_key = self.identities.cached_slot(
+                session, 0x9E, 0.8
+            ).openssh()
+            try:
+                key_policy = session.run(0.8, lambda card: card.get_key_policy(0x9E))
+            except PIVBaseException:
+                key_policy = None
+            wx.CallAfter(self.print_policy, key_policy)
+            wx.CallAfter(self.gen_btn.Enable)
             if caller == "start":
-                self.change_status("PIV key detected")
+                wx.CallAfter(self.change_status, "PIV key detected")
                 wx.PostEvent(
                     self, PivKeyEvent(type="Connected", data=piv_ssh_public_key)
                 )
@@ -204,14 +358,26 @@ class PIVageantwin(lib.gui.mainwin.PIVageant):
         except PIVCardTimeoutException:
             wx.PostEvent(self, PivKeyEvent(type="Timeout"))
         except PIVCardException as exc:
+            # The keys in the other slots are served without the 9E key
+            self.discover_keys(reader)
             err_msg = str(exc)
-            if err_msg == "Error status : 0x6A82" or err_msg == "Error status : 0x6A83":
-                self.gen_btn.Enable()
+            # 6A88 : metadata of an empty slot, on YubiKey 5.3+
+            if err_msg in (
+                "Error status : 0x6A82",
+                "Error status : 0x6A83",
+                "Error status : 0x6A88",
+            ):
+                wx.CallAfter(self.gen_btn.Enable)
                 wx.PostEvent(
                     self, PivKeyEvent(type="Error", data="No key found, generate a key")
                 )
             else:
                 wx.PostEvent(self, PivKeyEvent(type="Error", data="Error: " + err_msg))
+        except DataException as exc:
+            # Not an EC key in the 9E slot
+            self.discover_keys(reader)
+            wx.CallAfter(self.gen_btn.Enable)
+            wx.PostEvent(self, PivKeyEvent(type="Error", data="Error: " + str(exc)))
         except ConnectionException as exc:
             wx.PostEvent(self, PivKeyEvent(type="Error", data=str(exc)))
 
@@ -231,27 +397,21 @@ def get_path(fpath):
 PivKeyEvent, EVT_PIVKEY_EVENT = wx.lib.newevent.NewEvent()
 # PIVKEY_EVENT Attribute type :
 # "Timeout" (no key connected yey)
+# "Inserted" (from the card monitor)
+# "Removed" (from the card monitor)
 # "Connected"
 # "Error"
 # "Signed"
 # Attribute data :
 # for type Error : error message
 # for type Connected : public_key
+# for types Inserted and Removed : reader name
 
 
-def mainapp():
+def mainapp(agent):
     app = wx.App()
     windll.shcore.SetProcessDpiAwareness(2)
 
-    # Check if a Pageant is running
-    if check_pageant_running():
-        wx.MessageBox(
-            "A Pageant process is already running.",
-            "PIVageant info",
-            wx.OK | wx.ICON_WARNING | wx.STAY_ON_TOP,
-        )
-        return
-
     app.main_frame = PIVageantwin(None)
     app.main_frame.SetTitle(f"PIVageant  -  {__version__}")
     icon_file = get_path("res\\pivageant.ico")
@@ -262,14 +422,56 @@ def mainapp():
     app.main_frame.Bind(wx.EVT_ICONIZE, app.main_frame.sendtray)
     app.main_frame.Bind(EVT_PIVKEY_EVENT, app.main_frame.get_event)
     app.main_frame.trayicon = PIVagTray(app.main_frame, icon_file)
+    # Agent already serving the Pageant clients, with no key yet
+    agent.identities.key_name = KEY_NAME
+    agent.identities.debug = DEBUG_OUTPUT
+    app.main_frame.identities = agent.identities
+    # Reader of the key displayed
+    app.main_frame.reader = None
+    app.main_frame.signs_pending = 0
 
     app.main_frame.Update()
-    app.main_frame.waiting_for_pivkey("start")
+    if PROFILES_FILE:
+        device_profiles.load(PROFILES_FILE)
+    # Cards already inserted are notified at monitor start
+    app.main_frame.card_monitor = PIVCardMonitor(
+        app.main_frame.card_inserted, app.main_frame.card_removed, DEBUG_OUTPUT
+    )
+    # One agent for the application, its card workers are kept across
+    # the keys reads. Signatures callbacks come from these worker threads.
+    agent.sign_start_cb = partial(wx.CallAfter, app.main_frame.sign_status)
+    agent.sign_end_cb = partial(wx.CallAfter, app.main_frame.end_status)
+    agent.debug = DEBUG_OUTPUT
+    agent.card_present = app.main_frame.card_monitor.is_present
+    app.main_frame.agent = agent
+    app.main_frame.card_monitor.start()
+
+    if KEEPALIVE:
+        CardKeepalive(KEEPALIVE, KEEPALIVE_MAX_IDLE, DEBUG_OUTPUT).start()
+
+    if METRICS_FILE:
+        metrics_writer = SnapshotWriter(metrics, METRICS_FILE)
+        metrics_writer.start()
 
     app.MainLoop()
 
+    if METRICS_FILE:
+        metrics_writer.stop()
+        metrics_writer.join()
+
 
 if __name__ == "__main__":
     if "-v" in sys.argv[1:]:
         DEBUG_OUTPUT = is_tty()
-    mainapp()
+    for arg in sys.argv[1:]:
+        if arg.startswith("--metrics="):
+            METRICS_FILE = arg[len("--metrics=") :]
+        if arg.startswith("--keepalive="):
+            KEEPALIVE = float(arg[len("--keepalive=") :])
+        if arg.startswith("--keepalive-max-idle="):
+            KEEPALIVE_MAX_IDLE = float(arg[len("--keepalive-max-idle=") :])
+    if "--no-profiles" in sys.argv[1:]:
+        PROFILES_FILE = ""
+    if "--exclusive" in sys.argv[1:]:
+        set_connection_mode(share_mode="exclusive")
+    mainapp(PAGEANT_AGENT)
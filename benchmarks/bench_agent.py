@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# PIVageant : agent requests throughput and latency benchmark
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Replay the OpenSSH and PuTTY requests of the corpus through
+# process_command, against the virtual PIV card, and report the mean
+# latency and the latency percentiles by request type, for P-256 and
+# P-384 keys, on devices hashing on card or signing a host hash.
+# The requests per second are measured with concurrent clients sending
+# the requests of a type through AgentCore.dispatch.
+# The corpus is synthetic, built as OpenSSH and PuTTY send their requests.
+# Run from the repository root :
+#  python3 -m benchmarks.bench_agent
+#  python3 -m benchmarks.bench_agent --compare   flags the regressions
+#  python3 -m benchmarks.bench_agent --save      records the new baseline
+#  python3 -m benchmarks.bench_agent --make-corpus
+
+
+import argparse
+import gc
+import json
+import os
+import sys
+import warnings
+from concurrent.futures import Future
+from hashlib import sha256
+from os import urandom
+from threading import Barrier, Thread
+from time import perf_counter
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
+from lib.piv.virtual_card import VirtualPIVApplet, VirtualTransport, TOUCH_NEVER
+from lib.piv.piv_card import ALG_ECP256, ALG_ECP384
+from lib.piv.card_session import set_transport_factory
+from lib.agent.core import AgentCore
+from lib.agent.identities import IdentityRegistry
+from lib.pageantclient import process_command
+from lib.ssh.ssh_encodings import pack_reply
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_FILE = os.path.join(BENCH_DIR, "agent_corpus.json")
+BASELINE_FILE = os.path.join(BENCH_DIR, "agent_baseline.json")
+
+# Curve name : PIV algorithm, cryptography curve
+BENCH_CURVES = {
+    "nistp256": (ALG_ECP256, ec.SECP256R1()),
+    "nistp384": (ALG_ECP384, ec.SECP384R1()),
+}
+
+# Requests types, by agent message type
+REQUEST_TYPES = {11: "list", 13: "sign", 27: "extension"}
+
+# Session identifier length of the clients key exchanges
+# OpenSSH : curve25519-sha256, ecdh-sha2-nistp384
+# PuTTY : curve25519-sha256, diffie-hellman-group14-sha1
+CLIENTS_SESSION_IDS = {"openssh": (32, 48), "putty": (32, 20)}
+
+
+def bench_key(curve_name):
+    """Fixed key of the benchmark, the corpus signs with it"""
+    seed = sha256(f"PIVageant benchmark {curve_name}".encode("ascii")).digest()
+    return ec.derive_private_key(
+        int.from_bytes(seed, "big"), BENCH_CURVES[curve_name][1]
+    )
+
+
+def make_corpus():
+    """Agent messages as sent by OpenSSH and PuTTY, for the benchmark keys"""
+    registry = IdentityRegistry("ECPSSHKey")
+    requests = []
+    for curve_name in BENCH_CURVES:
+        identity = registry.add_key(None, 0x9E, public_point(bench_key(curve_name)))
+        for client, session_ids_len in CLIENTS_SESSION_IDS.items():
+            requests.append((client, curve_name, b"\x0b"))
+            if client == "openssh":
+                # OpenSSH 8.9+ binds the agent to the session first,
+                # PIVageant answers a failure
+                bind = pack_reply(b"session-bind@openssh.com") + urandom(120)
+                requests.append((client, curve_name, b"\x1b" + bind))
+            for session_id_len in session_ids_len:
+                for username in ("git", "deploy"):
+                    userauth = b"".join(
+                        (
+                            pack_reply(urandom(session_id_len)),
+                            b"\x32",
+                            pack_reply(username.encode("ascii")),
+                            pack_reply(b"ssh-connection"),
+                            pack_reply(b"publickey"),
+                            b"\x01",
+                            identity.userauth_key(),
+                        )
+                    )
+                    sign_req = b"".join(
+                        (
+                            b"\x0d",
+                            pack_reply(identity.key_blob),
+                            pack_reply(userauth),
+                            b"\x00\x00\x00\x00",
+                        )
+                    )
+                    requests.append((client, curve_name, sign_req))
+    return {
+        "version": 1,
+        "requests": [
+            {"client": client, "curve": curve_name, "message": message.hex()}
+            for client, curve_name, message in requests
+        ],
+    }
+
+
+def public_point(private_key):
+    return private_key.public_key().public_bytes(
+        Encoding.X962, PublicFormat.UncompressedPoint
+    )
+
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile of sorted values"""
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def replay(messages, identities, rounds):
+    """Durations of the requests replayed, by request type"""
+    durations = {}
+    for _ in range(rounds):
+        for message in messages:
+            start = perf_counter()
+            reply = process_command(False, identities, no_notify, no_notify, message)
+            duration = perf_counter() - start
+            if message[0] == 13 and reply[4] != 14:
+                raise Exception("Signature failed in the benchmark")
+            durations.setdefault(REQUEST_TYPES.get(message[0], "other"), []).append(
+                duration
+            )
+    return durations
+
+
+def throughput(agent, messages, clients, rounds):
+    """Requests per second of clients sending the messages at once
+
+    Each client waits for its reply before its next request, as the SSH
+    clients do. The requests completed are divided by the wall clock time
+    from the clients start to the last reply.
+    """
+    start_line = Barrier(clients + 1)
+    errors = []
+
+    def client(client_id):
+        start_line.wait()
+        try:
+            for _ in range(rounds):
+                for message in messages:
+                    reply = agent.dispatch(message, client_id)
+                    if isinstance(reply, Future):
+                        reply = reply.result()
+                    if message[0] == 13 and reply[4] != 14:
+                        raise Exception("Signature failed in the benchmark")
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [Thread(target=client, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_line.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    duration = perf_counter() - start
+    if errors:
+        raise errors[0]
+    return clients * rounds * len(messages) / duration
+
+
+def run_scenario(
+    corpus, curve_name, hash_on_card, rounds, repeats, apdu_latency, clients
+):
+    """Replay the corpus requests of a curve, returns the stats by type
+
+    Each measure is the median of the repeats, steadier from a run
+    to another than the best of the repeats. The clients share the
+    rounds for the requests per second.
+    """
+    applet = VirtualPIVApplet(hash_on_card=hash_on_card)
+    applet.import_key(
+        0x9E, BENCH_CURVES[curve_name][0], bench_key(curve_name), TOUCH_NEVER
+    )
+    set_transport_factory(lambda timeout: VirtualTransport(applet, apdu_latency))
+    identities = IdentityRegistry("ECPSSHKey")
+    identities.add_key(None, 0x9E, public_point(bench_key(curve_name)))
+    messages = [
+        bytes.fromhex(request["message"])
+        for request in corpus["requests"]
+        if request["curve"] == curve_name
+    ]
+    # Connection and applet selection out of the measures
+    warm_up = next(message for message in messages if message[0] == 13)
+    process_command(False, identities, no_notify, no_notify, warm_up)
+    messages_by_type = {}
+    for message in messages:
+        request_type = REQUEST_TYPES.get(message[0], "other")
+        messages_by_type.setdefault(request_type, []).append(message)
+    agent = AgentCore(identities)
+    repeated = {}
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            for request_type, values in replay(messages, identities, rounds).items():
+                values.sort()
+                repeated.setdefault(request_type, []).append(
+                    {
+                        "count": len(values),
+                        "rps": throughput(
+                            agent,
+                            messages_by_type[request_type],
+                            clients,
+                            max(1, rounds // clients),
+                        ),
+                        "mean_ms": sum(values) / len(values) * 1000,
+                        "p50_ms": percentile(values, 50) * 1000,
+                        "p95_ms": percentile(values, 95) * 1000,
+                        "p99_ms": percentile(values, 99) * 1000,
+                    }
+                )
+    finally:
+        agent.close()
+        if gc_was_enabled:
+            gc.enable()
+    stats = {}
+    for request_type, repeats_measures in repeated.items():
+        stats[request_type] = {"count": repeats_measures[0]["count"]}
+        for name, digits in (
+            ("rps", 1),
+            ("mean_ms", 4),
+            ("p50_ms", 4),
+            ("p95_ms", 4),
+            ("p99_ms", 4),
+        ):
+            values = sorted(measures[name] for measures in repeats_measures)
+            stats[request_type][name] = round(values[len(values) // 2], digits)
+    return stats
+
+
+def no_notify(*args):
+    pass
+
+
+def slower(value, base, threshold, min_delta):
+    """Latency worse than the threshold in %, and than min_delta in ms"""
+    return value - base > max(base * threshold / 100, min_delta)
+
+
+def compare(results, baseline, threshold, min_delta, flag=True):
+    """Print the changes from the baseline, returns the regressions count"""
+    regressions = 0
+    for scenario, stats in results.items():
+        for request_type, values in stats.items():
+            base = baseline.get(scenario, {}).get(request_type)
+            if base is None or "rps" not in base or "mean_ms" not in base:
+                continue
+            changes = [
+                (values[name] / base[name] - 1) * 100
+                for name in ("rps", "mean_ms", "p50_ms", "p95_ms")
+            ]
+            # The tail latency is too noisy at this scale to flag on
+            regression = flag and (
+                changes[0] < -threshold
+                or any(
+                    slower(values[name], base[name], threshold, min_delta)
+                    for name in ("mean_ms", "p50_ms")
+                )
+            )
+            regressions += regression
+            print(
+                f"{scenario:<22} {request_type:<10} rps {changes[0]:+6.1f} %   "
+                f"mean {changes[1]:+6.1f} %   p50 {changes[2]:+6.1f} %   "
+                f"p95 {changes[3]:+6.1f} %   {'REGRESSION' if regression else 'ok'}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PIVageant agent benchmark")
+    parser.add_argument("--rounds", type=int, default=200, help="corpus replays")
+    parser.add_argument("--repeats", type=int, default=5, help="median of repeats")
+    parser.add_argument(
+        "--clients", type=int, default=4, help="concurrent clients, for the rps"
+    )
+    parser.add_argument(
+        "--apdu-latency", type=float, default=0.0, help="virtual card ms per APDU"
+    )
+    parser.add_argument("--save", action="store_true", help="record the baseline")
+    parser.add_argument(
+        "--compare", action="store_true", help="compare with the baseline"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=30.0, help="regression threshold in %%"
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.01,
+        help="regression minimal latency change in ms",
+    )
+    parser.add_argument(
+        "--make-corpus", action="store_true", help="write a new requests corpus"
+    )
+    args = parser.parse_args()
+    # TripleDES deprecation of the admin authentication
+    warnings.simplefilter("ignore")
+
+    if args.make_corpus:
+        with open(CORPUS_FILE, "w") as corpus_file:
+            json.dump(make_corpus(), corpus_file, indent=1)
+        print("Corpus written in", CORPUS_FILE)
+        return
+    with open(CORPUS_FILE, "r") as corpus_file:
+        corpus = json.load(corpus_file)
+
+    results = {}
+    for curve_name in BENCH_CURVES:
+        for hash_on_card in (False, True):
+            scenario = f"{curve_name} {'card-hash' if hash_on_card else 'host-hash'}"
+            results[scenario] = run_scenario(
+                corpus,
+                curve_name,
+                hash_on_card,
+                args.rounds,
+                args.repeats,
+                args.apdu_latency / 1000,
+                args.clients,
+            )
+            for request_type, stats in results[scenario].items():
+                print(
+                    f"{scenario:<22} {request_type:<10} {stats['rps']:9.1f} rps   "
+                    f"mean {stats['mean_ms']:8.3f} ms   "
+                    f"p50 {stats['p50_ms']:8.3f} ms   p95 {stats['p95_ms']:8.3f} ms   "
+                    f"p99 {stats['p99_ms']:8.3f} ms"
+                )
+
+    if args.compare:
+        with open(BASELINE_FILE, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        settings = ("rounds", "repeats", "apdu_latency_ms", "clients")
+        run_settings = (args.rounds, args.repeats, args.apdu_latency, args.clients)
+        comparable = tuple(baseline.get(name) for name in settings) == run_settings
+        print(
+            f"\nCompared with the baseline, threshold {args.threshold} % "
+            f"and {args.min_delta} ms :"
+        )
+        if not comparable:
+            print(
+                "Baseline recorded with other settings, no regression flagged : "
+                + ", ".join(f"{name} {baseline.get(name)}" for name in settings)
+            )
+        if compare(
+            results, baseline["results"], args.threshold, args.min_delta, comparable
+        ):
+            sys.exit(1)
+    if args.save:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(
+                {
+                    "rounds": args.rounds,
+                    "repeats": args.repeats,
+                    "apdu_latency_ms": args.apdu_latency,
+                    "clients": args.clients,
+                    "results": results,
+                },
+                baseline_file,
+                indent=1,
+            )
+        print("Baseline written in", BASELINE_FILE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# PIVageant : TLV decoding micro-benchmarks
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compare decode_dol and TLV on the responses parsed in the card layer
+# Run from the repository root :
+#  python3 -m benchmarks.bench_tlv
+
+
+from os import urandom
+from timeit import repeat
+from lib.piv.piv_card import decode_dol, encode_do, TLV, ALG_ECP384
+from lib.piv.genkeys import build_certificate
+
+
+def get_data_response():
+    """GET DATA response of the 9E certificate object, 384 bits key"""
+    cert = build_certificate(b"\x04" + urandom(96), ALG_ECP384)
+    return b"\x53" + encode_do(cert)
+
+
+def sign_response():
+    """GENERAL AUTHENTICATE response with an ECDSA P-384 DER signature"""
+    der_sig = b"\x30\x65\x02\x31\x00" + urandom(48) + b"\x02\x30" + urandom(48)
+    return b"\x7C" + encode_do(b"\x82" + encode_do(der_sig))
+
+
+def best_time_us(func, number):
+    """Best time of a call, in microseconds"""
+    return min(repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def compare(name, old_func, new_func, number=20000):
+    assert old_func() == new_func()
+    old_time = best_time_us(old_func, number)
+    new_time = best_time_us(new_func, number)
+    print(
+        f"{name:<24} decode_dol {old_time:7.2f} us   "
+        f"TLV {new_time:7.2f} us   x{old_time / new_time:.1f}"
+    )
+
+
+def main():
+    cert_resp = get_data_response()
+    sig_resp = sign_response()
+    print(f"GET DATA response : {len(cert_resp)} bytes")
+    print(f"Sign response : {len(sig_resp)} bytes")
+    compare(
+        "certificate 53",
+        lambda: decode_dol(cert_resp)["53"],
+        lambda: bytes(TLV(cert_resp)[0x53]),
+    )
+    compare(
+        "certificate 53 view",
+        lambda: decode_dol(cert_resp)["53"],
+        lambda: TLV(cert_resp)[0x53],
+    )
+    compare(
+        "signature 7C/82",
+        lambda: decode_dol(sig_resp)["7C"]["82"],
+        lambda: bytes(TLV(sig_resp).find(0x7C, 0x82)),
+    )
+
+
+if __name__ == "__main__":
+    main()
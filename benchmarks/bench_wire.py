@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# PIVageant : SSH agent wire codec micro-benchmarks
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compare the ssh_encodings helpers and the wire codec on the messages
+# of the agent requests path
+# Run from the repository root :
+#  python3 -m benchmarks.bench_wire
+
+
+from os import urandom
+from timeit import repeat
+from lib.agent.identities import IdentityRegistry
+from lib.ssh.ssh_encodings import (
+    pack_reply,
+    parse_sign_command,
+    parse_datasig,
+    decode_sig,
+)
+from lib.ssh.wire import (
+    WireReader,
+    SignRequest,
+    UserauthRequest,
+    SignResponse,
+)
+
+
+def sign_message(identity):
+    """SSH_AGENTC_SIGN_REQUEST content, as sent by OpenSSH"""
+    userauth = b"".join(
+        (
+            pack_reply(urandom(32)),
+            b"\x32",
+            pack_reply(b"git"),
+            pack_reply(b"ssh-connection"),
+            pack_reply(b"publickey"),
+            b"\x01",
+            identity.userauth_key(),
+        )
+    )
+    return pack_reply(identity.key_blob) + pack_reply(userauth) + b"\0\0\0\0"
+
+
+def der_signature():
+    """ECDSA P-384 DER signature"""
+    return b"\x30\x65\x02\x31\x00" + urandom(48) + b"\x02\x30" + urandom(48)
+
+
+def old_parse(message):
+    key_blob, signature_data = parse_sign_command(message, False)
+    return key_blob, parse_datasig(signature_data)
+
+
+def new_parse(message):
+    request = SignRequest.parse(WireReader(message))
+    return request, UserauthRequest.parse(request.data)
+
+
+def same_parse(message):
+    key_blob, sig_data = old_parse(message)
+    request, userauth = new_parse(message)
+    return (key_blob, sig_data["username"], sig_data["publickey"]) == (
+        request.key_blob,
+        userauth.username,
+        pack_reply(bytes(userauth.algorithm)) + pack_reply(bytes(userauth.key_blob)),
+    )
+
+
+def old_identities(identities):
+    keys = identities.list()
+    nkeys = len(keys).to_bytes(4, byteorder="big")
+    return b"\x0c" + nkeys + b"".join(identity.wire() for identity in keys)
+
+
+def new_identities(identities):
+    # Built once after a keys change
+    return identities.identities_answer()
+
+
+def old_sign_response(key_type, der_sig):
+    signature = pack_reply(decode_sig(der_sig))
+    return b"\x0e" + pack_reply(pack_reply(key_type) + signature)
+
+
+def new_sign_response(key_type, der_sig):
+    return SignResponse.from_der(key_type, der_sig).encode()
+
+
+def best_times_us(funcs, number, rounds=20):
+    """Best time of a call of each function, in microseconds
+
+    The functions are timed in turn, so a load change affects them all.
+    """
+    best = [float("inf")] * len(funcs)
+    for _ in range(rounds):
+        for index, func in enumerate(funcs):
+            best[index] = min(best[index], min(repeat(func, number=number, repeat=1)))
+    return [best_time / number * 1e6 for best_time in best]
+
+
+def compare(name, old_func, new_func, number=5000, check=True):
+    if check:
+        assert old_func() == new_func()
+    old_time, new_time = best_times_us((old_func, new_func), number)
+    print(
+        f"{name:<24} ssh_encodings {old_time:7.2f} us   "
+        f"wire {new_time:7.2f} us   x{old_time / new_time:.1f}"
+    )
+
+
+def main():
+    identities = IdentityRegistry("ECPSSHKey")
+    for slot in (0x9E, 0x9A, 0x9C, 0x9D):
+        identities.add_key(None, slot, b"\x04" + urandom(96))
+    identity = identities.list()[0]
+    message = sign_message(identity)
+    der_sig = der_signature()
+    print(f"Sign request : {len(message)} bytes")
+    assert same_parse(message)
+    compare(
+        "sign request parsing",
+        lambda: old_parse(message),
+        lambda: new_parse(message),
+        check=False,
+    )
+    compare(
+        "identities answer",
+        lambda: old_identities(identities),
+        lambda: new_identities(identities),
+    )
+    compare(
+        "sign response",
+        lambda: old_sign_response(identity.key_type, der_sig),
+        lambda: new_sign_response(identity.key_type, der_sig),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# PIVageant : startup import time report
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Load the entry scripts, without starting them, in a new interpreter
+# with -X importtime, and report their imports total time and the
+# slowest imports, of the fastest of the runs.
+# Run from the repository root :
+#  python3 -m benchmarks.import_profile
+#  python3 -m benchmarks.import_profile --top=20 lib.agent.core
+
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The GUI and the headless agent
+DEFAULT_TARGETS = ["PIVageant.pyw", "pivageant_agent.py"]
+
+# Executes a script file under another name than __main__, so it doesn't start
+LOAD_SCRIPT = (
+    "import importlib.machinery, importlib.util\n"
+    "loader = importlib.machinery.SourceFileLoader('startup_profile', {path!r})\n"
+    "spec = importlib.util.spec_from_loader('startup_profile', loader)\n"
+    "loader.exec_module(importlib.util.module_from_spec(spec))\n"
+)
+
+
+def target_code(target):
+    """Python code loading a script file, or importing a module"""
+    if target.endswith((".py", ".pyw")):
+        return LOAD_SCRIPT.format(path=os.path.join(ROOT_DIR, target))
+    return f"import {target}\n"
+
+
+def parse_importtime(output):
+    """Imports of an -X importtime output : (name, depth, self us, cumul us)"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2 - 1
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def profile(target):
+    """Imports of a target, and its error when it failed to load"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", target_code(target)],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    error = None
+    if result.returncode:
+        error_lines = [
+            line
+            for line in result.stderr.splitlines()
+            if not line.startswith("import time:")
+        ]
+        error = error_lines[-1] if error_lines else f"exit {result.returncode}"
+    return parse_importtime(result.stderr), error
+
+
+def report(target, imports, error, top):
+    total_ms = sum(imports_self for _, _, imports_self, _ in imports) / 1000
+    print(f"{target} : {len(imports)} modules, {total_ms:.1f} ms")
+    if error:
+        print(f"  Load failed : {error}")
+    print("  Slowest top level imports (cumulative) :")
+    top_level = sorted(
+        (entry for entry in imports if entry[1] == 0),
+        key=lambda entry: entry[3],
+        reverse=True,
+    )
+    for name, _, _, cumulative_us in top_level[:top]:
+        print(f"    {cumulative_us / 1000:8.1f} ms   {name}")
+    print("  Slowest modules (self) :")
+    for name, _, self_us, _ in sorted(imports, key=lambda entry: -entry[2])[:top]:
+        print(f"    {self_us / 1000:8.1f} ms   {name}")
+    print("  PIVageant modules (cumulative) :")
+    for name, _, _, cumulative_us in imports:
+        if name.startswith("lib."):
+            print(f"    {cumulative_us / 1000:8.1f} ms   {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PIVageant startup imports")
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        default=DEFAULT_TARGETS,
+        help="scripts files or modules names",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="fastest of runs")
+    parser.add_argument("--top", type=int, default=10, help="imports listed")
+    args = parser.parse_args()
+
+    for target in args.targets:
+        runs = [profile(target) for _ in range(args.runs)]
+        imports, error = min(runs, key=lambda run: sum(entry[2] for entry in run[0]))
+        report(target, imports, error, args.top)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# SSH agent protocol core for PIVageant, independent of the transport
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from lib.agent.scheduler import SignScheduler
+from lib.pageantclient import process_command, ERROR_CODE, OP_SIGN_REQUEST
+from lib.ssh.ssh_encodings import pack_reply, read_len
+from lib.metrics import metrics
+
+# As in OpenSSH, maximum agent message length
+MAX_MESSAGE_LEN = 256 * 1024
+
+
+def no_notify(*args):
+    pass
+
+
+class AgentCore:
+    """SSH agent requests processing, shared by the agent transports
+
+    A transport reads a message (without its length header),
+    and sends back the reply of process, length header included.
+    With dispatch, identities listing is answered right away from memory,
+    and signatures are queued to the card worker thread of the reader
+    holding the key, the devices in different readers sign in parallel.
+    A signature with a key of a device not inserted fails right away.
+    """
+
+    def __init__(
+        self,
+        identities,
+        sign_start_cb=None,
+        sign_end_cb=None,
+        debug=False,
+        max_queue=32,
+        sign_timeout=30.0,
+        fair=True,
+        card_present=None,
+    ):
+        # identities : IdentityRegistry of the keys served
+        # sign_start_cb(username, card_info) : signature starts, touch to expect
+        # sign_end_cb(status_text) : signature ended
+        # max_queue : sign requests waiting per reader, more are rejected
+        # sign_timeout : seconds a sign request can wait for the card
+        # fair : round robin among the clients, else FIFO
+        # card_present(reader) : is the device in the reader, None when unknown
+        self.identities = identities
+        self.sign_start_cb = sign_start_cb or no_notify
+        self.sign_end_cb = sign_end_cb or no_notify
+        self.debug = debug
+        self.max_queue = max_queue
+        self.sign_timeout = sign_timeout
+        self.fair = fair
+        self.card_present = card_present
+        # Sign schedulers by reader
+        self.schedulers = {}
+
+    def get_scheduler(self, reader):
+        scheduler = self.schedulers.get(reader)
+        if scheduler is None:
+            scheduler = self.schedulers[reader] = SignScheduler(
+                self.process,
+                pack_reply(ERROR_CODE),
+                self.max_queue,
+                self.sign_timeout,
+                self.fair,
+                f"card {reader}" if reader else "card",
+            )
+        return scheduler
+
+    def sign_reader(self, message):
+        """Reader of the key of a sign request, None if unknown"""
+        if len(message) < 5:
+            return None
+        key_blob = message[5 : 5 + read_len(message[1:5])]
+        identity = self.identities.find(key_blob)
+        if identity is None:
+            return None
+        return identity.reader
+
+    def process(self, message):
+        """Process an agent message, returns the framed reply"""
+        if not message:
+            return pack_reply(ERROR_CODE)
+        return process_command(
+            self.debug,
+            self.identities,
+            self.sign_start_cb,
+            self.sign_end_cb,
+            bytes(message),
+        )
+
+    def dispatch(self, message, client_id=None):
+        """Non blocking processing of an agent message
+
+        Returns the framed reply, or a Future of it for a signature.
+        The sign callbacks are then called from the card worker thread.
+        client_id identifies the client for a fair scheduling,
+        cancel the Future when the client gave up.
+        """
+        if message and message[0] == OP_SIGN_REQUEST:
+            reader = self.sign_reader(message)
+            if self.card_present and not self.card_present(reader):
+                # Would wait for the card until the connection timeout
+                metrics.count("sign_no_card")
+                if self.debug:
+                    print("Sign request failed, PIV device not inserted")
+                return pack_reply(ERROR_CODE)
+            scheduler = self.get_scheduler(reader)
+            return scheduler.submit(message, client_id)
+        return self.process(message)
+
+    def close(self):
+        for scheduler in self.schedulers.values():
+            scheduler.close()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Headless PIVageant agent, without GUI toolkit
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import sys
+from lib.piv.card_session import get_session
+from lib.agent.core import AgentCore
+from lib.agent.identities import IdentityRegistry
+from lib.agent.notifier import Notifier
+
+
+def default_socket_path():
+    """Agent socket in the user runtime directory, else in the home"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "pivageant", "agent.sock")
+    return os.path.join(os.path.expanduser("~"), ".pivageant", "agent.sock")
+
+
+class HeadlessAgent:
+    """Serve the keys of the PIV devices inserted, with no window
+
+    The keys of a device are discovered at its insertion. They are served
+    on a Unix domain socket, or with the Pageant window protocol on
+    Windows. Signatures and devices events go to the notifier.
+
+    card_monitor is the devices monitor class, PIVCardMonitor by default.
+    It is built with (on_insert, on_remove, debug), and has start, stop
+    and is_present(reader). With another monitor and an emulated device
+    transport (set_transport_factory), pyscard is not needed.
+    """
+
+    def __init__(
+        self, key_name, notifier=None, socket_path=None, debug=False, card_monitor=None
+    ):
+        self.notifier = notifier or Notifier()
+        self.socket_path = socket_path or default_socket_path()
+        self.debug = debug
+        self.identities = IdentityRegistry(key_name, debug)
+        if card_monitor is None:
+            # Imported here, pyscard is only needed for the PC/SC devices
+            from lib.piv.card_monitor import PIVCardMonitor
+
+            card_monitor = PIVCardMonitor
+        self.card_monitor = card_monitor(self.card_inserted, self.card_removed, debug)
+        self.agent = AgentCore(
+            self.identities,
+            self.notifier.sign_start,
+            self.notifier.sign_end,
+            debug,
+            card_present=self.card_monitor.is_present,
+        )
+
+    def card_inserted(self, reader):
+        self.identities.start_discovery(get_session(self.debug, reader))
+        self.notifier.status(f"PIV device inserted in {reader}")
+
+    def card_removed(self, reader):
+        # The keys are still listed, their signatures fail right away
+        self.identities.stop_discovery(reader)
+        get_session(self.debug, reader).close()
+        self.notifier.status(f"PIV device removed from {reader}")
+
+    def run(self):
+        """Serve until interrupted, or terminated"""
+        self.card_monitor.start()
+        try:
+            if sys.platform == "win32":
+                self.run_pageant()
+            else:
+                self.run_unix()
+        finally:
+            self.card_monitor.stop()
+            self.agent.close()
+
+    def run_unix(self):
+        # Imported here, asyncio is only needed on this transport
+        from lib.agent.unix_socket import UnixAgentServer
+
+        server = UnixAgentServer(self.agent, self.socket_path, self.debug)
+        self.notifier.status(f"SSH agent listening on {self.socket_path}")
+        server.run()
+
+    def run_pageant(self):
+        # Windows only modules
+        from lib.gui.getwin import check_pageant_running
+        from lib.gui.pageant_win import MainWin
+
+        if check_pageant_running():
+            raise OSError("A Pageant process is already running")
+        self.notifier.status("Pageant agent started")
+        MainWin(self.agent.dispatch)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+# SSH identities of the PIV device key slots for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from base64 import b64encode
+from hashlib import sha256
+from threading import Lock, Thread
+from lib.piv.piv_card import (
+    KEY_SLOTS_CERTS,
+    ALG_ECP256,
+    ALG_ECP384,
+    TLV,
+    PIVBaseException,
+    PIVCardException,
+    DataException,
+)
+from lib.piv.device_profiles import device_profiles
+from lib.ssh.ssh_encodings import encode_pubkey, encode_openssh, pack_reply
+from lib.ssh.wire import IdentitiesAnswer
+
+
+# Card Authentication first, the slot of the keys generated by PIVageant
+SLOTS_ORDER = [0x9E, 0x9A, 0x9C, 0x9D] + list(range(0x82, 0x96))
+
+# EC point length : PIV algorithm, SSH curve name
+CURVES = {65: (ALG_ECP256, "nistp256"), 97: (ALG_ECP384, "nistp384")}
+
+
+def cert_pubkey(cert_object):
+    """EC public key point from a PIV certificate data object content"""
+    # Imported here, the devices with metadata need no certificate parsing
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
+
+    # Object is 70 certificate, 71 CertInfo, FE error detection
+    cert = x509.load_der_x509_certificate(bytes(TLV(cert_object)[0x70]))
+    pubkey = cert.public_key()
+    if not isinstance(pubkey, ec.EllipticCurvePublicKey):
+        raise DataException("Not an EC key certificate")
+    return pubkey.public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)
+
+
+def read_slot_pubkey(card, slot):
+    """EC public key point of a card slot
+
+    From the Yubico metadata when available, a certificate is not needed,
+    else from the slot certificate.
+    """
+    if card.has_metadata():
+        return card.get_public_key(slot)
+    return cert_pubkey(card.get_data(KEY_SLOTS_CERTS[slot]))
+
+
+def slot_needs_pin(card, slot):
+    """The key of a slot signs only after the PIN is verified
+
+    As the slot PIN policy when known, else as the PIV default policy,
+    the PIN is needed for all the slots but the Card Authentication one.
+    """
+    policy = card.get_key_policy(slot)
+    if policy is None or policy["pin"] == "default":
+        return slot != 0x9E
+    return policy["pin"] != "never"
+
+
+def fingerprint(key_blob):
+    """SHA256 fingerprint of a key, as shown by ssh-keygen -l"""
+    return "SHA256:" + b64encode(sha256(key_blob).digest()).decode().rstrip("=")
+
+
+class Identity:
+    """An EC key of a PIV slot, with its SSH encodings
+
+    The encodings used by the requests are computed once, at key load.
+    """
+
+    __slots__ = (
+        "slot",
+        "point",
+        "comment",
+        "reader",
+        "algo",
+        "curve_name",
+        "key_type",
+        "key_blob",
+        "fingerprint",
+        "userauth",
+        "entry",
+    )
+
+    def __init__(self, slot, point, comment, reader=None):
+        # reader : reader of the device holding the key, None for any reader
+        if len(point) not in CURVES:
+            raise DataException("Unsupported EC key length")
+        self.slot = slot
+        self.reader = reader
+        self.point = point
+        self.comment = comment
+        self.algo, self.curve_name = CURVES[len(point)]
+        self.key_type = b"ecdsa-sha2-" + self.curve_name.encode("ascii")
+        self.key_blob = encode_pubkey(point, self.key_type.decode(), self.curve_name)
+        self.fingerprint = fingerprint(self.key_blob)
+        self.userauth = pack_reply(self.key_type) + pack_reply(self.key_blob)
+        self.entry = (self.key_blob, comment.encode("utf8"))
+
+    def userauth_key(self):
+        """Public key as in the RFC4252 userauth data to sign"""
+        return self.userauth
+
+    def wire(self):
+        """Key blob and comment, as in the identities list answer"""
+        return pack_reply(self.entry[0]) + pack_reply(self.entry[1])
+
+    def openssh(self):
+        return encode_openssh(self.point, self.comment)
+
+
+class IdentityRegistry:
+    """SSH identities of the PIV device, found by their key blob
+
+    The keys are discovered from the slots metadata or certificates, in
+    the slots order, for each reader. Discovery of the other slots runs
+    in a background thread, sharing the reader card session with the
+    signatures. The keys known from the device profile are served
+    before being checked with the card. The identities answer is built
+    once after a keys change.
+    """
+
+    def __init__(self, key_name, debug=False):
+        self.key_name = key_name
+        self.debug = debug
+        self.lock = Lock()
+        self.identities = {}
+        # IDENTITIES_ANSWER message of the keys, None when to be built
+        self.answer = None
+        # Readers in their discovery order
+        self.readers = []
+        # Token of the discovery running, by reader. A discovery only
+        # registers its keys while its token is the one of its reader.
+        self.discovering = {}
+
+    def slot_comment(self, slot):
+        if slot == 0x9E:
+            return self.key_name
+        return f"{self.key_name}-{slot:02X}"
+
+    def add(self, identity, discovery=None):
+        with self.lock:
+            if discovery and self.discovering.get(identity.reader) is not discovery:
+                # Discovery stopped, its keys read are no longer valid
+                return
+            # Replaces the key of the same slot, and the same key
+            # last known in another reader
+            identities = [
+                ident
+                for ident in self.identities.values()
+                if (ident.reader, ident.slot) != (identity.reader, identity.slot)
+                and ident.key_blob != identity.key_blob
+            ]
+            identities.append(identity)
+            if identity.reader not in self.readers:
+                self.readers.append(identity.reader)
+            identities.sort(
+                key=lambda ident: (
+                    self.readers.index(ident.reader),
+                    SLOTS_ORDER.index(ident.slot),
+                )
+            )
+            self.identities = {ident.key_blob: ident for ident in identities}
+            self.answer = None
+
+    def find(self, key_blob):
+        """Identity of a key blob, None if unknown"""
+        return self.identities.get(bytes(key_blob))
+
+    def list(self):
+        return list(self.identities.values())
+
+    def identities_answer(self):
+        """SSH_AGENT_IDENTITIES_ANSWER message of the keys"""
+        answer = self.answer
+        if answer is None:
+            with self.lock:
+                if self.answer is None:
+                    self.answer = IdentitiesAnswer(
+                        [ident.entry for ident in self.identities.values()]
+                    ).encode()
+                answer = self.answer
+        return answer
+
+    def clear(self):
+        with self.lock:
+            self.discovering.clear()
+            self.identities = {}
+            self.readers = []
+            self.answer = None
+
+    def remove_reader(self, reader):
+        """Forget the keys of a reader, its device was removed"""
+        with self.lock:
+            self.discovering.pop(reader, None)
+            self.identities = {
+                key_blob: ident
+                for key_blob, ident in self.identities.items()
+                if ident.reader != reader
+            }
+            self.answer = None
+            if reader in self.readers:
+                self.readers.remove(reader)
+
+    def stop_discovery(self, reader):
+        """The device was removed, its keys are kept"""
+        with self.lock:
+            self.discovering.pop(reader, None)
+
+    def end_discovery(self, reader, discovery):
+        with self.lock:
+            if self.discovering.get(reader) is discovery:
+                del self.discovering[reader]
+
+    def remove_slot(self, reader, slot, discovery=None):
+        with self.lock:
+            if discovery and self.discovering.get(reader) is not discovery:
+                return
+            self.identities = {
+                key_blob: ident
+                for key_blob, ident in self.identities.items()
+                if (ident.reader, ident.slot) != (reader, slot)
+            }
+            self.answer = None
+
+    def add_key(self, reader, slot, point, discovery=None):
+        identity = Identity(slot, point, self.slot_comment(slot), reader)
+        self.add(identity, discovery)
+        return identity
+
+    def read_slot(self, session, slot, timeout, discovery=None):
+        """Read the key of a slot from the card, and register it
+
+        The keys needing the PIN are not served, the agent never asks it.
+        The Card Authentication key is always served, as displayed.
+        """
+
+        def read_key(card):
+            # Checked first, the key or certificate of a slot refused isn't read
+            if slot != 0x9E and slot_needs_pin(card, slot):
+                raise DataException(f"The key in slot {slot:02X} needs the PIN")
+            return card.device_id, read_slot_pubkey(card, slot)
+
+        card_id, point = session.run(timeout, read_key)
+        device_profiles.set_key(card_id, slot, point)
+        return self.add_key(session.reader, slot, point, discovery)
+
+    def cached_slot(self, session, slot, timeout):
+        """Key of a slot from the device profile, read from the card if unknown"""
+        card_id = session.run(timeout, lambda card: card.device_id)
+        point = device_profiles.get_key(card_id, slot)
+        if point is None:
+            return self.read_slot(session, slot, timeout)
+        return self.add_key(session.reader, slot, point)
+
+    def discover(self, session, slots, timeout=5):
+        """Read the keys of the slots, skipping the empty ones"""
+        discovery = object()
+        with self.lock:
+            self.discovering[session.reader] = discovery
+        try:
+            card_id = session.run(timeout, lambda card: card.device_id)
+        except PIVBaseException:
+            self.end_discovery(session.reader, discovery)
+            return
+        for slot in slots:
+            point = device_profiles.get_key(card_id, slot)
+            if point:
+                self.add_key(session.reader, slot, point, discovery)
+        for slot in slots:
+            if self.discovering.get(session.reader) is not discovery:
+                # Registry cleared, card removed, or discovery started again
+                break
+            try:
+                identity = self.read_slot(session, slot, timeout, discovery)
+            except (PIVCardException, DataException, ValueError):
+                # Empty slot, not an EC key, or a key needing the PIN
+                self.remove_slot(session.reader, slot, discovery)
+                if device_profiles.get_key(card_id, slot):
+                    device_profiles.drop_keys(card_id, [slot])
+                continue
+            except PIVBaseException:
+                # Card lost
+                break
+            if self.debug:
+                print(f"Key found in slot {slot:02X} :", identity.openssh())
+        self.end_discovery(session.reader, discovery)
+
+    def start_discovery(self, session, slots=SLOTS_ORDER):
+        """Discover the keys of the slots in a background thread"""
+        discovery = Thread(
+            target=self.discover, args=(session, slots), name="identities", daemon=True
+        )
+        discovery.start()
+        return discovery
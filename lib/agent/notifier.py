@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Signature notifications of the headless PIVageant agent
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import logging
+import sys
+
+
+def sign_prompt(username, card_info):
+    """Text of a signature starting, with the touch to expect"""
+    if card_info["isYubico"]:
+        return f"Touch the PIV device to sign as user {username}"
+    return f"Signing with the PIV device as user {username}"
+
+
+class Notifier:
+    """Signatures and devices notifications, ignored
+
+    The methods are called from the agent card worker and the card monitor
+    threads, as the AgentCore sign callbacks and the devices events.
+    """
+
+    def sign_start(self, username, card_info):
+        pass
+
+    def sign_end(self, status_text):
+        pass
+
+    def status(self, status_text):
+        pass
+
+
+class LogNotifier(Notifier):
+    """Notifications as logging records, for a service"""
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("pivageant")
+
+    def sign_start(self, username, card_info):
+        self.logger.info(sign_prompt(username, card_info))
+
+    def sign_end(self, status_text):
+        self.logger.info(status_text)
+
+    def status(self, status_text):
+        self.logger.info(status_text)
+
+
+class ConsoleNotifier(Notifier):
+    """Notifications printed, for a terminal or a login script"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def print(self, text):
+        print(f"PIVageant : {text}", file=self.stream, flush=True)
+
+    def sign_start(self, username, card_info):
+        self.print(sign_prompt(username, card_info))
+
+    def sign_end(self, status_text):
+        self.print(status_text)
+
+    def status(self, status_text):
+        self.print(status_text)
+
+
+class CallbackNotifier(Notifier):
+    """Notifications to the given functions, those not given are ignored"""
+
+    def __init__(self, on_sign_start=None, on_sign_end=None, on_status=None):
+        # on_sign_start(username, card_info), card_info["isYubico"] when
+        # a touch is expected, on_sign_end(status_text), on_status(status_text)
+        self.on_sign_start = on_sign_start
+        self.on_sign_end = on_sign_end
+        self.on_status = on_status
+
+    def sign_start(self, username, card_info):
+        if self.on_sign_start:
+            self.on_sign_start(username, card_info)
+
+    def sign_end(self, status_text):
+        if self.on_sign_end:
+            self.on_sign_end(status_text)
+
+    def status(self, status_text):
+        if self.on_status:
+            self.on_status(status_text)
+
+
+# Notifiers by name, for the command line
+NOTIFIERS = {"log": LogNotifier, "console": ConsoleNotifier, "none": Notifier}
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Signature requests scheduler for the PIVageant card worker
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import monotonic
+from lib.metrics import metrics
+
+
+class SignJob:
+    __slots__ = ("message", "client_id", "deadline", "submitted", "future")
+
+    def __init__(self, message, client_id, deadline):
+        self.message = message
+        self.client_id = client_id
+        self.deadline = deadline
+        self.submitted = monotonic()
+        self.future = Future()
+
+
+class SignScheduler:
+    """Queue the sign requests to a single card worker thread
+
+    Requests are served round robin among the clients (or FIFO when
+    fair is False), up to max_depth requests waiting. A request still
+    waiting after timeout seconds, or cancelled by its client, never
+    reaches the card. Rejected and expired requests get failure_reply.
+    """
+
+    def __init__(
+        self, process, failure_reply, max_depth=32, timeout=30.0, fair=True, name="card"
+    ):
+        # process(message) is the blocking card operation
+        self.process = process
+        self.failure_reply = failure_reply
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.fair = fair
+        self.queues = OrderedDict()
+        self.depth = 0
+        self.running = True
+        self.condition = Condition()
+        self.worker = Thread(target=self.work, name=name, daemon=True)
+        self.worker.start()
+
+    def submit(self, message, client_id=None):
+        """Queue a request, returns a Future of the reply"""
+        if not self.fair:
+            client_id = None
+        job = SignJob(message, client_id, monotonic() + self.timeout)
+        with self.condition:
+            if self.depth >= self.max_depth or not self.running:
+                metrics.count("sign_rejected")
+                job.future.set_result(self.failure_reply)
+                return job.future
+            queue = self.queues.get(client_id)
+            if queue is None:
+                queue = self.queues[client_id] = deque()
+            queue.append(job)
+            self.depth += 1
+            self.condition.notify()
+        return job.future
+
+    def next_job(self):
+        """Wait for the next job, in round robin over the clients queues"""
+        with self.condition:
+            while self.running and not self.depth:
+                self.condition.wait()
+            if not self.running:
+                return None
+            client_id, queue = self.queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                # Client goes at the end of the round
+                self.queues[client_id] = queue
+            self.depth -= 1
+            return job
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                metrics.count("sign_cancelled")
+                continue
+            metrics.observe("sign_queue_wait", (monotonic() - job.submitted) * 1000)
+            if monotonic() > job.deadline:
+                metrics.count("sign_expired")
+                job.future.set_result(self.failure_reply)
+                continue
+            try:
+                job.future.set_result(self.process(job.message))
+            except Exception as exc:
+                job.future.set_exception(exc)
+
+    def close(self):
+        """Stop the worker, waiting requests are cancelled"""
+        with self.condition:
+            self.running = False
+            for queue in self.queues.values():
+                for job in queue:
+                    job.future.cancel()
+            self.queues.clear()
+            self.depth = 0
+            self.condition.notify()
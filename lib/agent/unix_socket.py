@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# SSH agent Unix domain socket server for PIVageant (SSH_AUTH_SOCK)
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import asyncio
+import os
+import socket
+import stat
+import struct
+from concurrent.futures import Future
+from lib.agent.core import MAX_MESSAGE_LEN
+from lib.ssh.ssh_encodings import read_len
+
+
+def peer_pid(writer):
+    """Process id of the client, to schedule per client process"""
+    sock = writer.get_extra_info("socket")
+    if hasattr(socket, "SO_PEERCRED") and sock is not None:
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        return struct.unpack("3i", creds)[0]
+    return id(writer)
+
+
+def socket_in_use(socket_path):
+    """Does a process listen on the Unix socket path ?"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(1)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Left by a process stopped
+        return False
+    except socket.timeout:
+        # Listening, with its backlog full
+        return True
+    finally:
+        probe.close()
+    return True
+
+
+async def wait_reply(reply, reader):
+    """Wait for a Future reply, cancelled when the client disconnects
+
+    Returns the reply, and the data read ahead of a next request.
+    Returns None when the client gave up.
+    """
+    reply = asyncio.wrap_future(reply)
+    read_ahead = asyncio.ensure_future(reader.read(1))
+    await asyncio.wait((reply, read_ahead), return_when=asyncio.FIRST_COMPLETED)
+    if not reply.done():
+        data_ahead = read_ahead.result()
+        if not data_ahead:
+            # EOF, request cancelled if not yet sent to the card
+            reply.cancel()
+            return None
+        return await reply, data_ahead
+    # The pending read must be over before the next request is read
+    read_ahead.cancel()
+    await asyncio.wait((read_ahead,))
+    if read_ahead.cancelled():
+        return reply.result(), b""
+    return reply.result(), read_ahead.result()
+
+
+class UnixAgentServer:
+    """Serve an AgentCore on a Unix domain socket, for many clients at once"""
+
+    def __init__(self, agent_core, socket_path, debug=False):
+        self.agent = agent_core
+        self.socket_path = socket_path
+        self.debug = debug
+        self.server = None
+
+    async def handle_client(self, reader, writer):
+        client_id = peer_pid(writer)
+        data_ahead = b""
+        try:
+            while True:
+                header = await reader.readexactly(4 - len(data_ahead))
+                msg_len = read_len(data_ahead + header)
+                data_ahead = b""
+                if msg_len > MAX_MESSAGE_LEN:
+                    if self.debug:
+                        print("Agent message too long :", msg_len)
+                    break
+                message = await reader.readexactly(msg_len)
+                # Signatures run in the agent card worker
+                reply = self.agent.dispatch(message, client_id)
+                if isinstance(reply, Future):
+                    reply_ahead = await wait_reply(reply, reader)
+                    if reply_ahead is None:
+                        break
+                    reply, data_ahead = reply_ahead
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Client disconnected
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Listen on the socket, only the current user can connect"""
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, mode=0o700)
+        if os.path.lexists(self.socket_path):
+            if not stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                raise OSError(f"{self.socket_path} exists and is not a socket")
+            if socket_in_use(self.socket_path):
+                raise OSError(f"An agent is already listening on {self.socket_path}")
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(
+                self.handle_client, path=self.socket_path
+            )
+        finally:
+            os.umask(old_umask)
+        if self.debug:
+            print("SSH agent listening on", self.socket_path)
+
+    async def serve(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        # The socket of another agent, not started, is kept
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def run(self):
+        """Serve until interrupted"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
@@ -33,7 +33,20 @@ def get_classname_from_title(title):
 
 PAGEANT_CLASSTITLE = b"Pageant"
 
+# MessageBox style : MB_OK | MB_ICONWARNING | MB_TOPMOST
+MB_WARNING_TOPMOST = 0x00040030
+
 
 def check_pageant_running():
     # Check if there's a windows with title and class name = Pageant
     return PAGEANT_CLASSTITLE == get_classname_from_title(PAGEANT_CLASSTITLE)
+
+
+def warn_pageant_running():
+    # Native message box, shown before the GUI toolkit is loaded
+    ctypes.windll.user32.MessageBoxW(
+        None,
+        "A Pageant process is already running.",
+        "PIVageant info",
+        MB_WARNING_TOPMOST,
+    )
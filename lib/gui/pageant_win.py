@@ -16,7 +16,9 @@
 
 import mmap
 import platform
+from concurrent.futures import Future
 from secrets import randbits
+from threading import Thread
 from ctypes import (
     WinDLL,
     wintypes,
@@ -140,6 +142,13 @@ user32.DefWindowProcW.argtypes = (
     wintypes.LPARAM,
 )
 user32.DefWindowProcW.restype = LRESULT
+user32.PostMessageW.argtypes = (
+    wintypes.HWND,
+    wintypes.UINT,
+    wintypes.WPARAM,
+    wintypes.LPARAM,
+)
+user32.PostMessageW.restype = wintypes.BOOL
 
 CW_USEDEFAULT = -2147483648
 IDI_APPLICATION = MAKEINTRESOURCEW(32512)
@@ -152,13 +161,19 @@ IDC_ARROW = MAKEINTRESOURCEW(32512)
 
 WM_DESTROY = 2
 WM_COPYDATA = 74
+WM_APP = 0x8000
+# Posted by the card worker when a reply is ready
+WM_AGENT_REPLY = WM_APP + 1
 
 AGENT_DATATYPE = 0x804E50BA
 CLOSE_MAGIC = randbits(31)
 class_id = 0
 
 
-def MainWin(callback):
+def MainWin(callback, idle_cb=None):
+    # callback(message, client_id) returns the reply, or a Future of the reply
+    # idle_cb is called after each message dispatched, as the GUI toolkit
+    # loop doesn't run while this loop pumps the messages
 
     class_name = "Pageant"
 
@@ -166,7 +181,10 @@ def MainWin(callback):
         global class_id
         if message == WM_COPYDATA:
             # Entry point from the SSH client
-            handle_wmcopy(lParam, hwnd, callback)
+            handle_wmcopy(lParam, hwnd, callback, idle_cb)
+            return 0
+        if message == WM_AGENT_REPLY:
+            # Only wakes up the message loop waiting for a reply
             return 0
         if message == WM_DESTROY:
             if wParam == CLOSE_MAGIC:
@@ -213,11 +231,34 @@ def MainWin(callback):
     while user32.GetMessageW(byref(msg), None, 0, 0) != 0:
         user32.TranslateMessage(byref(msg))
         user32.DispatchMessageW(byref(msg))
+        if idle_cb:
+            idle_cb()
 
     return msg.wParam
 
 
-def handle_wmcopy(wmcp_adr, hwmn, handle_command):
+def wait_reply(future, hwnd, idle_cb):
+    """Pump the messages until the future reply is ready"""
+    # Other clients WM_COPYDATA are processed meanwhile, in nested calls.
+    # A nested call returns first, so a reply can't be sent before
+    # the replies of the requests received after it.
+    future.add_done_callback(
+        lambda _: user32.PostMessageW(hwnd, WM_AGENT_REPLY, 0, 0)
+    )
+    msg = wintypes.MSG()
+    while not future.done():
+        if user32.GetMessageW(byref(msg), None, 0, 0) == 0:
+            # WM_QUIT, let the main loop get it
+            user32.PostQuitMessage(msg.wParam)
+            return None
+        user32.TranslateMessage(byref(msg))
+        user32.DispatchMessageW(byref(msg))
+        if idle_cb:
+            idle_cb()
+    return future.result()
+
+
+def handle_wmcopy(wmcp_adr, hwmn, handle_command, idle_cb=None):
     # process WM_COPYDATA message
     # from a pointer address to a COPYDATASTRUCT
     msg_copy_ptr = cast(wmcp_adr, POINTER(COPYDATASTRUCT))
@@ -239,13 +280,29 @@ def handle_wmcopy(wmcp_adr, hwmn, handle_command):
         if retlen > 8188:
             raise Exception("Too many data received")
         cmd_rcvd = conn_mmap.read(retlen)
-        resp = handle_command(cmd_rcvd)
+        # Clients name the mmap after their thread
+        resp = handle_command(cmd_rcvd, mmap_name)
+        if isinstance(resp, Future):
+            resp = wait_reply(resp, hwmn, idle_cb)
+            if resp is None:
+                return
         # Reply to the SSH client
         conn_mmap.seek(0)
         conn_mmap.write(resp)
         user32.ReplyMessage(len(resp))
 
 
+def start_window_thread(callback):
+    """Run the Pageant window and its messages loop in a new thread
+
+    The window answers without the GUI toolkit loop, from its start.
+    """
+    window_thread = Thread(target=MainWin, args=(callback,), name="pageant")
+    window_thread.daemon = True
+    window_thread.start()
+    return window_thread
+
+
 def get_window_id():
     return user32.FindWindowA(b"Pageant", b"Pageant")
 
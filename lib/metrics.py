@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Latency and counters instrumentation for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import json
+import logging
+import os
+from threading import Lock, Thread, Event
+from time import perf_counter, time
+
+
+# Histograms buckets upper bounds, in milliseconds
+BUCKETS_MS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    float("inf"),
+)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, duration_ms):
+        idx = 0
+        while duration_ms > BUCKETS_MS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += duration_ms
+        if duration_ms < self.min:
+            self.min = duration_ms
+        if duration_ms > self.max:
+            self.max = duration_ms
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the percentile, max for the last"""
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100
+        seen = 0
+        for idx, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKETS_MS[idx], self.max)
+        return self.max
+
+    def to_dict(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3),
+            "min_ms": round(self.min, 3),
+            "max_ms": round(self.max, 3),
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "buckets": {
+                str(bound): bucket_count
+                for bound, bucket_count in zip(BUCKETS_MS, self.counts)
+                if bucket_count
+            },
+        }
+
+
+class StageTimer:
+    """Context manager measuring a stage duration"""
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, (perf_counter() - self.start) * 1000)
+        return False
+
+
+class Metrics:
+    """Per stage latency histograms and events counters"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time()
+
+    def stage(self, name):
+        """with metrics.stage("name"): records the block duration"""
+        return StageTimer(self, name)
+
+    def observe(self, name, duration_ms):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(duration_ms)
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def snapshot(self):
+        """Current metrics as a dict, JSON serializable"""
+        with self.lock:
+            return {
+                "timestamp": time(),
+                "uptime_s": round(time() - self.started, 1),
+                "counters": dict(self.counters),
+                "stages": {
+                    name: histogram.to_dict()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time()
+
+
+class SnapshotWriter(Thread):
+    """Periodically write the metrics snapshot in a JSON file"""
+
+    def __init__(self, metrics_obj, file_path, interval=10.0):
+        super().__init__(daemon=True)
+        self.metrics = metrics_obj
+        self.file_path = file_path
+        self.interval = interval
+        self.stop_event = Event()
+
+    def write(self):
+        # Atomic replace, readers never see a partial file
+        temp_path = self.file_path + ".tmp"
+        try:
+            with open(temp_path, "w") as snapshot_file:
+                json.dump(self.metrics.snapshot(), snapshot_file, indent=1)
+            os.replace(temp_path, self.file_path)
+        except OSError as exc:
+            # Logged, the next snapshots are still written
+            logging.getLogger("pivageant").warning(
+                "Metrics snapshot not written : %s", exc
+            )
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+        self.write()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# Process-wide metrics
+metrics = Metrics()
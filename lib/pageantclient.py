@@ -15,98 +15,137 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 
-from cryptography import x509
-from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
-from lib.ssh.ssh_encodings import (
-    encode_openssh,
-    pack_reply,
-    read_len,
-    parse_sign_command,
-    parse_datasig,
-    decode_sig,
+from time import perf_counter
+from lib.ssh.ssh_encodings import encode_openssh, pack_reply
+from lib.ssh.wire import (
+    WireReader,
+    SignRequest,
+    SignResponse,
+    UserauthRequest,
 )
-from lib.piv.piv_card import PIVcard, ALG_ECP256, ALG_ECP384
+from lib.piv.piv_card import PIVCardTimeoutException
+from lib.piv.card_session import get_session
+from lib.agent.identities import read_slot_pubkey
+from lib.metrics import metrics
+
+# Idle seconds after which a signature counts as a first signature,
+# the device may have been suspended
+FIRST_SIGN_IDLE = 60
 
 OP_REQUEST_IDS = 11
-IDS_RESPONSE = 12
 OP_SIGN_REQUEST = 13
-SIGN_RESPONSE = 14
 ERROR_CODE = b"\x05"
 
 
-def read_pubkey(keyname, timeout, debug):
-    """Read the PIV key certificate"""
-    # X509 decoding, then encoded to OpenSSH format
-    my_piv_card = PIVcard(timeout, debug)
-    cert_raw = my_piv_card.get_data("5FC101")
-    cert = x509.load_der_x509_certificate(cert_raw[4:-5])
-    pubkey = cert.public_key().public_bytes(
-        Encoding.X962, PublicFormat.UncompressedPoint
-    )
+def read_pubkey(keyname, timeout, debug, slot=0x9E):
+    """Read the PIV key, from metadata or certificate"""
+    pubkey = get_session(debug).run(timeout, lambda card: read_slot_pubkey(card, slot))
     return encode_openssh(pubkey, keyname)
 
 
-def process_command(debug_agent, ssh_wire_key, show_main_win, finish_cb, data=b""):
+def process_command(debug_agent, identities, show_main_win, finish_cb, data=b""):
     """Entry point to this Pageant client"""
     request_type = data[0]
-    request_data = data[1:]
+    # Parsed in place, the strings are views of the message
+    request_data = memoryview(data)[1:]
     if debug_agent:
         print("Command received")
         print("Request type :", request_type)
-        print(" data :", request_data)
+        print(" data :", bytes(request_data))
     reply = ERROR_CODE
-    try:
-        if request_type == OP_REQUEST_IDS:
-            reply = list_identitites(ssh_wire_key)
-        if request_type == OP_SIGN_REQUEST:
-            # sign request
-            reply = sign_request(request_data, ssh_wire_key, show_main_win, debug_agent)
-            finish_cb("Signed OK")
-    except Exception as exc:
-        if debug_agent:
-            print("Error when processing command :")
-            print(exc)
-        if request_type == OP_SIGN_REQUEST and str(exc) == "Error status : 0x6982":
-            finish_cb("Not approved in time")
-    finally:
-        return pack_reply(reply)
+    metrics.count("requests")
+    # The user modal opened is closed by finish_cb, also on a failure
+    modal_opened = []
+
+    def open_user_modal(*args):
+        modal_opened.append(True)
+        show_main_win(*args)
 
+    with metrics.stage("process_command"):
+        try:
+            if request_type == OP_REQUEST_IDS:
+                metrics.count("requests_identities")
+                reply = list_identitites(identities)
+            if request_type == OP_SIGN_REQUEST:
+                # sign request
+                metrics.count("requests_sign")
+                reply = sign_request(
+                    request_data, identities, open_user_modal, debug_agent
+                )
+                finish_cb("Signed OK")
+        except Exception as exc:
+            metrics.count("errors")
+            if isinstance(exc, PIVCardTimeoutException):
+                metrics.count("timeouts")
+            if debug_agent:
+                print("Error when processing command :")
+                print(exc)
+            if modal_opened:
+                if str(exc) == "Error status : 0x6982":
+                    metrics.count("not_approved")
+                    finish_cb("Not approved in time")
+                else:
+                    finish_cb("Signature failed")
+        finally:
+            with metrics.stage("pack_reply"):
+                reply = pack_reply(reply)
+            return reply
 
-def list_identitites(ssh_wire_key):
+
+def list_identitites(identities):
     """Raw list of keys"""
-    # return b"\x0c\x00\x00\x00\x01" + openssh_to_wire()
-    list_type = IDS_RESPONSE.to_bytes(1, byteorder="big")
-    n_ids_int = 1
-    nkeys = n_ids_int.to_bytes(4, byteorder="big")
-    return list_type + nkeys + ssh_wire_key
+    return identities.identities_answer()
 
 
-def sign_request(sign_req, local_ssh_key, open_user_modal, debug_piv=False):
+def sign_request(sign_req, identities, open_user_modal, debug_piv=False):
     """Parse, check and sign the signature query"""
-    key_type = local_ssh_key[24:27]
-    if key_type == b"256":
-        keyalgo = ALG_ECP256
-    elif key_type == b"384":
-        keyalgo = ALG_ECP384
-    else:
-        raise Exception("Incompatible key type")
-    SIG_HEADER_STRING = b"ecdsa-sha2-nistp" + key_type
-    signature_data = parse_sign_command(sign_req, debug_piv)
-    current_card = PIVcard(5, debug_piv)
+    with metrics.stage("parse_sign_command"):
+        request = SignRequest.parse(WireReader(sign_req))
+        if debug_piv:
+            print("Key blob for signature :", bytes(request.key_blob))
+            print("Data to sign :", bytes(request.data))
+        if request.flags:
+            raise Exception("Unvalid signature query, must be compliant for ECC.")
+    identity = identities.find(request.key_blob)
+    if identity is None:
+        raise Exception("Unknown key")
+    if debug_piv:
+        print("Signing with the key", identity.fingerprint)
+    session = get_session(debug_piv, identity.reader)
+    idle_time = session.idle_time()
+    card_start = perf_counter()
+    with metrics.stage("card_connect"):
+        current_card = session.get_card(5)
+    connect_ms = (perf_counter() - card_start) * 1000
     if debug_piv:
         print("PIV device detected")
     # Check data to be signed
-    sig_data = parse_datasig(signature_data)
-    local_pubkey = pack_reply(local_ssh_key[4 : 4 + read_len(local_ssh_key)])
-    sig_header = pack_reply(SIG_HEADER_STRING)
+    with metrics.stage("parse_datasig"):
+        userauth = UserauthRequest.parse(request.data)
     # Sign query is for the same public key ?
-    if sig_data["publickey"] != sig_header + local_pubkey:
+    if (userauth.algorithm, userauth.key_blob) != (
+        identity.key_type,
+        identity.key_blob,
+    ):
         raise Exception("Public key mismatch")
     # All checks OK, proceed to sign
-    open_user_modal(sig_data["username"], {"isYubico": current_card.is_yubico})
-    key_slot_gen = 0x9E
-    der_signature = current_card.sign_ec(keyalgo, key_slot_gen, signature_data)
-    del current_card
-    sig_type = SIGN_RESPONSE.to_bytes(1, byteorder="big")
-    signature = pack_reply(decode_sig(der_signature))
-    return sig_type + pack_reply(sig_header + signature)
+    open_user_modal(userauth.username, {"isYubico": current_card.is_yubico})
+    signature_data = bytes(request.data)
+    with metrics.stage("sign_ec"):
+        der_signature, sign_apdu_ms = session.run(
+            5,
+            lambda card: (
+                card.sign_ec(identity.algo, identity.slot, signature_data),
+                card.last_apdu_ms,
+            ),
+        )
+    if idle_time is None or idle_time >= FIRST_SIGN_IDLE:
+        # Device wake up, from the commands of the signature : the connection
+        # and the GENERAL AUTHENTICATE round trip, without the prompt
+        first_sign_ms = connect_ms + sign_apdu_ms
+        metrics.observe("first_sign", first_sign_ms)
+        if debug_piv:
+            idle_info = "first use" if idle_time is None else f"{idle_time:.0f} s idle"
+            print(f"Device wake up after {idle_info} : {first_sign_ms:.1f} ms")
+    with metrics.stage("decode_sig"):
+        return SignResponse.from_der(identity.key_type, der_signature).encode()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# PIV device insertion and removal monitoring for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+try:
+    from smartcard.CardMonitoring import CardMonitor, CardObserver
+except ModuleNotFoundError as exc:
+    raise ModuleNotFoundError("pyscard not installed or was not found") from exc
+from lib.piv.piv_card import PIVcard
+from lib.piv.pcsc_context import pcsc_context
+
+
+class PIVCardMonitor(CardObserver):
+    """Notify compatible PIV devices insertion and removal, from PC/SC events"""
+
+    def __init__(self, on_insert, on_remove, debug=False):
+        # Callbacks are called from the monitoring thread, with the reader name
+        super().__init__()
+        self.on_insert = on_insert
+        self.on_remove = on_remove
+        self.debug = debug
+        self.readers = set()
+        self.monitor = None
+
+    def start(self):
+        """Start monitoring, cards already inserted are notified as inserted"""
+        if self.monitor is None:
+            self.monitor = CardMonitor()
+            self.monitor.addObserver(self)
+
+    def stop(self):
+        if self.monitor is not None:
+            self.monitor.deleteObserver(self)
+            self.monitor = None
+
+    def is_present(self, reader=None):
+        """Is a compatible PIV device inserted ? In the reader when given"""
+        if reader is None:
+            return bool(self.readers)
+        return reader in self.readers
+
+    def update(self, observable, handlers):
+        added_cards, removed_cards = handlers
+        # A card removed with its reader, or inserted in a new reader
+        known_readers = pcsc_context.readers or []
+        if removed_cards or any(
+            str(card.reader) not in known_readers for card in added_cards
+        ):
+            pcsc_context.readers_changed()
+        for card in removed_cards:
+            reader = str(card.reader)
+            if reader in self.readers:
+                self.readers.discard(reader)
+                if self.debug:
+                    print("PIV device removed from", reader)
+                self.on_remove(reader)
+        for card in added_cards:
+            if card.atr in PIVcard.compat_cards:
+                reader = str(card.reader)
+                self.readers.add(reader)
+                if self.debug:
+                    print("PIV device inserted in", reader)
+                self.on_insert(reader)
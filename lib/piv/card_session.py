@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# PIV card session manager for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from threading import Lock, RLock
+from time import monotonic, perf_counter
+from lib.piv.piv_card import (
+    PIVcard,
+    PIVBaseException,
+    PIVCardException,
+    ConnectionException,
+    CardResetException,
+    SW_APPLET_NOT_SELECTED,
+)
+from lib.metrics import metrics
+
+
+class PIVSession:
+    """Keep a PIV card connected, with its applet selected, across requests
+
+    The applet is selected again only when the card was reset, or when
+    another application sharing the card selected another applet.
+    """
+
+    def __init__(
+        self,
+        debug=False,
+        transport_factory=None,
+        reader=None,
+        share_mode="shared",
+        disposition="leave",
+    ):
+        # transport_factory(connect_timeout) returns a card transport,
+        # when None the card is reached through PC/SC, in the reader
+        self.debug = debug
+        self.transport_factory = transport_factory
+        self.reader = reader
+        self.share_mode = share_mode
+        self.disposition = disposition
+        self.card = None
+        # PC/SC context of this session, used under its lock
+        self.pcsc = None
+        self.lock = RLock()
+        # monotonic time of the last request, and of the last keepalive
+        self.last_used = None
+        self.last_keepalive = 0.0
+
+    def get_card(self, connect_timeout):
+        """Return the connected card, connects if needed"""
+        with self.lock:
+            if self.card is None:
+                transport = None
+                if self.transport_factory:
+                    transport = self.transport_factory(connect_timeout)
+                elif self.pcsc is None:
+                    # Imported here, as the transport, pyscard may be missing
+                    from lib.piv.pcsc_context import PCSCContext, pcsc_context
+
+                    self.pcsc = PCSCContext(pcsc_context)
+                self.card = PIVcard(
+                    connect_timeout,
+                    self.debug,
+                    transport,
+                    self.reader,
+                    self.share_mode,
+                    self.disposition,
+                    self.pcsc,
+                )
+            return self.card
+
+    def run(self, connect_timeout, operation):
+        """Call operation(card), recovering once from a card reset or removal"""
+        with self.lock:
+            try:
+                return self.run_once(connect_timeout, operation)
+            finally:
+                self.last_used = monotonic()
+
+    def run_once(self, connect_timeout, operation):
+        # Called with the lock held
+        card = self.get_card(connect_timeout)
+        try:
+            return operation(card)
+        except CardResetException:
+            if self.debug:
+                print("PIV card was reset, selecting the applet again")
+            metrics.count("card_resets")
+            card.reconnect()
+        except PIVCardException as exc:
+            if exc.sw_code not in SW_APPLET_NOT_SELECTED:
+                raise
+            if self.debug:
+                print("PIV applet was deselected, selecting it again")
+            metrics.count("applet_reselects")
+            card.select_applet()
+        except ConnectionException:
+            if self.debug:
+                print("PIV card connection lost, reconnecting")
+            self.close()
+            card = self.get_card(connect_timeout)
+        return operation(card)
+
+    def idle_time(self):
+        """Seconds since the last request, None if never used"""
+        if self.last_used is None:
+            return None
+        return monotonic() - self.last_used
+
+    def last_activity(self):
+        """monotonic time of the last APDU sent, request or keepalive"""
+        return max(self.last_used or 0.0, self.last_keepalive)
+
+    def keepalive(self):
+        """Send a keepalive APDU, unless the card is busy or not connected"""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.card is None:
+                return
+            start = perf_counter()
+            try:
+                self.card.ping()
+            except PIVBaseException as exc:
+                # The next request reconnects
+                if self.debug:
+                    print("Keepalive failed :", exc)
+                return
+            finally:
+                self.last_keepalive = monotonic()
+            duration_ms = (perf_counter() - start) * 1000
+            metrics.count("keepalives")
+            metrics.observe("keepalive", duration_ms)
+            if self.debug:
+                print(f"Keepalive {self.reader or ''} : {duration_ms:.1f} ms")
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Disconnect the card, next request will connect again"""
+        with self.lock:
+            if self.card is not None:
+                self.card.disconnect()
+                self.card = None
+
+
+# Sessions by reader name, None is the first device found in any reader
+_sessions = {}
+_sessions_lock = Lock()
+# PC/SC share mode and disposition of the sessions
+_connection_mode = {"share_mode": "shared", "disposition": "leave"}
+
+
+def get_session(debug=False, reader=None):
+    """Return the process-wide PIV session of a reader
+
+    Each reader has its own session and lock,
+    so the devices in different readers are used in parallel.
+    """
+    with _sessions_lock:
+        session = _sessions.get(reader)
+        if session is None:
+            session = _sessions[reader] = PIVSession(
+                debug, reader=reader, **_connection_mode
+            )
+    session.debug = debug
+    return session
+
+
+def set_transport_factory(transport_factory, reader=None):
+    """Use another card transport for the process-wide session of a reader"""
+    session = get_session(reader=reader)
+    with session.lock:
+        session.close()
+        session.transport_factory = transport_factory
+
+
+def all_sessions():
+    with _sessions_lock:
+        return list(_sessions.values())
+
+
+def set_connection_mode(share_mode="shared", disposition="leave"):
+    """PC/SC share mode and disposition of the sessions
+
+    Applies at the next connection of the sessions. "exclusive" keeps
+    the other applications from using the device while it is connected.
+    """
+    with _sessions_lock:
+        _connection_mode["share_mode"] = share_mode
+        _connection_mode["disposition"] = disposition
+        for session in _sessions.values():
+            session.share_mode = share_mode
+            session.disposition = disposition
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Persistent cache of the PIV devices profiles for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import json
+import os
+from threading import Lock
+
+
+# Profile format version, a different version is discarded
+PROFILES_VERSION = 1
+
+# Cache file in the user local data, else in the XDG cache directory
+if os.environ.get("LOCALAPPDATA"):
+    DEFAULT_PROFILES_FILE = os.path.join(
+        os.environ["LOCALAPPDATA"], "PIVageant", "devices.json"
+    )
+else:
+    DEFAULT_PROFILES_FILE = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "pivageant",
+        "devices.json",
+    )
+
+
+class DeviceProfiles:
+    """Device facts and public keys, by device ATR and serial number
+
+    A profile holds what the card layer learns at connection (label,
+    algorithms, Yubico version, extended length), the public keys read
+    from the slots, and the policies of the keys generated. The file is
+    rewritten at each change, disabled when no file path is set.
+    """
+
+    def __init__(self, file_path=None):
+        self.lock = Lock()
+        self.profiles = {}
+        self.file_path = None
+        if file_path:
+            self.load(file_path)
+
+    def load(self, file_path):
+        """Use the cache file, unreadable or outdated content is discarded"""
+        with self.lock:
+            self.file_path = file_path
+            self.profiles = {}
+            try:
+                with open(file_path, "r") as profiles_file:
+                    content = json.load(profiles_file)
+                if content.get("version") == PROFILES_VERSION:
+                    self.profiles = content["devices"]
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+
+    def save(self):
+        # Atomic replace, as the metrics snapshot
+        if not self.file_path:
+            return
+        content = {"version": PROFILES_VERSION, "devices": self.profiles}
+        temp_path = self.file_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            with open(temp_path, "w") as profiles_file:
+                json.dump(content, profiles_file, separators=(",", ":"))
+            os.replace(temp_path, self.file_path)
+        except OSError:
+            pass
+
+    def get(self, device_id):
+        """Profile dict of a device, None if unknown"""
+        if not self.file_path or not device_id:
+            return None
+        with self.lock:
+            profile = self.profiles.get(device_id)
+            return dict(profile) if profile else None
+
+    def put(self, device_id, profile):
+        """Record the device facts, keeping its known keys"""
+        if not self.file_path or not device_id:
+            return
+        with self.lock:
+            known = self.profiles.get(device_id, {})
+            self.profiles[device_id] = dict(
+                profile,
+                keys=known.get("keys", {}),
+                policies=known.get("policies", {}),
+            )
+            self.save()
+
+    def get_key(self, device_id, slot):
+        """Public key bytes of a device slot, None if unknown"""
+        profile = self.get(device_id)
+        if not profile:
+            return None
+        point_hex = profile["keys"].get(f"{slot:02X}")
+        return bytes.fromhex(point_hex) if point_hex else None
+
+    def set_key(self, device_id, slot, point):
+        if not self.file_path or not device_id:
+            return
+        with self.lock:
+            if device_id in self.profiles:
+                self.profiles[device_id]["keys"][f"{slot:02X}"] = point.hex()
+                self.save()
+
+    def get_policy(self, device_id, slot):
+        """PIN and touch policies dict of a device slot, None if unknown"""
+        profile = self.get(device_id)
+        if not profile:
+            return None
+        return profile.get("policies", {}).get(f"{slot:02X}")
+
+    def set_policy(self, device_id, slot, policy):
+        if not self.file_path or not device_id:
+            return
+        with self.lock:
+            if device_id in self.profiles:
+                policies = self.profiles[device_id].setdefault("policies", {})
+                policies[f"{slot:02X}"] = policy
+                self.save()
+
+    def drop_keys(self, device_id, slots=None, policies=False):
+        """Forget the keys of the slots, of all the slots when None
+
+        The keys policies are also forgotten when policies is True,
+        the keys were generated again.
+        """
+        if not self.file_path or not device_id:
+            return
+        with self.lock:
+            profile = self.profiles.get(device_id, {})
+            slots_datas = [profile.get("keys")]
+            if policies:
+                slots_datas.append(profile.get("policies"))
+            changed = False
+            for slots_data in slots_datas:
+                for slot in list(slots_data or {}):
+                    if slots is None or int(slot, 16) in slots:
+                        del slots_data[slot]
+                        changed = True
+            if changed:
+                self.save()
+
+
+def device_id(atr, serial):
+    """Profile key of a device, only for a device with a serial number"""
+    return f"{bytes(atr).hex()}-{serial}"
+
+
+# Process-wide profiles, disabled until loaded
+device_profiles = DeviceProfiles()
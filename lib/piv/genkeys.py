@@ -16,13 +16,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 
-import subprocess
 from lib.piv.piv_card import (
-    PIVcard,
     PIVCardException,
     ALG_ECP256,
     ALG_ECP384,
 )
+from lib.piv.card_session import get_session
 from lib.ssh.ssh_encodings import decode_ssh, encode_openssh
 
 
@@ -82,8 +81,19 @@ def build_certificate(datakey, key_algo):
 fake_or_PKI = "fake"
 
 
-def generate_key(debug=False):
-    current_card = PIVcard(0.5, debug)
+def generate_key(debug=False, reader=None, touch_policy="always", pin_policy="default"):
+    session = get_session(debug, reader)
+    with session.lock:
+        return generate_key_card(
+            session.get_card(0.5), debug, touch_policy, pin_policy
+        )
+
+
+def generate_key_card(
+    current_card, debug=False, touch_policy="always", pin_policy="default"
+):
+    # Policies on Yubico devices : touch "always", "cached" or "never",
+    # PIN "default" (never for the card auth slot), "never", "once", "always"
     admin_keyref = 0x9B
     algo_used = 0x03
     # Auth admin
@@ -105,11 +115,16 @@ def generate_key(debug=False):
     keyalgo = 0x14  # EC 384
     try:
         # try with EC 384 bits
-        pubkey_resp = current_card.gen_asymmetric(key_slot_gen, keyalgo)
+        pubkey_resp = current_card.gen_asymmetric(
+            key_slot_gen, keyalgo, touch_policy, pin_policy
+        )
     except PIVCardException:
         keyalgo = 0x11  # Fallback to EC 256
-        pubkey_resp = current_card.gen_asymmetric(key_slot_gen, keyalgo)
-    openssh_pukey = encode_openssh(pubkey_resp["86"], KEY_NAME)
+        pubkey_resp = current_card.gen_asymmetric(
+            key_slot_gen, keyalgo, touch_policy, pin_policy
+        )
+    pubkey_bin = bytes(pubkey_resp[0x86])
+    openssh_pukey = encode_openssh(pubkey_bin, KEY_NAME)
     if debug:
         print("\nCard authentication key generated with EC :\n")
         print(openssh_pukey)
@@ -119,11 +134,12 @@ def generate_key(debug=False):
         print(key_parts[1])
         print("---- END SSH2 PUBLIC KEY ----")
         print("")
-    pubkey_bin = pubkey_resp["86"]
     # Generate certificate for this key
     if fake_or_PKI == "fake":
         cert_data = build_certificate(pubkey_bin, keyalgo)
     else:
+        import subprocess
+
         f = open("pivkey.pub", "w")
         f.write(openssh_pukey)
         f.close()
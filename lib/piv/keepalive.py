@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Card connection keepalive for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import ctypes
+import glob
+import os
+import sys
+from threading import Thread, Event
+from time import monotonic
+from lib.piv.card_session import all_sessions
+
+
+class SystemPowerStatus(ctypes.Structure):
+    _fields_ = [
+        ("ACLineStatus", ctypes.c_ubyte),
+        ("BatteryFlag", ctypes.c_ubyte),
+        ("BatteryLifePercent", ctypes.c_ubyte),
+        ("SystemStatusFlag", ctypes.c_ubyte),
+        ("BatteryLifeTime", ctypes.c_ulong),
+        ("BatteryFullLifeTime", ctypes.c_ulong),
+    ]
+
+
+def on_battery():
+    """Is the computer running on battery ? False when unknown"""
+    if sys.platform == "win32":
+        status = SystemPowerStatus()
+        if not ctypes.windll.kernel32.GetSystemPowerStatus(ctypes.byref(status)):
+            return False
+        # 0 offline, 1 online, 255 unknown
+        return status.ACLineStatus == 0
+    mains_online = []
+    for supply in glob.glob("/sys/class/power_supply/*"):
+        try:
+            with open(os.path.join(supply, "type"), "r") as type_file:
+                if type_file.read().strip() != "Mains":
+                    continue
+            with open(os.path.join(supply, "online"), "r") as online_file:
+                mains_online.append(online_file.read().strip() == "1")
+        except OSError:
+            continue
+    return bool(mains_online) and not any(mains_online)
+
+
+class CardKeepalive(Thread):
+    """Keep the connected devices awake, with a cheap APDU when idle
+
+    The readers and tokens put in USB selective suspend are slow to
+    answer the first command after an idle period. A device idle for
+    interval seconds gets a keepalive APDU, until it was not used for
+    max_idle seconds. No keepalive is sent on battery power.
+    """
+
+    def __init__(self, interval=30.0, max_idle=3600.0, debug=False):
+        super().__init__(name="keepalive", daemon=True)
+        self.interval = interval
+        self.max_idle = max_idle
+        self.debug = debug
+        self.stop_event = Event()
+        self.paused = False
+
+    def run(self):
+        while not self.stop_event.wait(min(self.interval / 2, 5.0)):
+            battery = on_battery()
+            if battery != self.paused:
+                self.paused = battery
+                if self.debug:
+                    print("Keepalive", "paused on battery" if battery else "resumed")
+            if battery:
+                continue
+            now = monotonic()
+            for session in all_sessions():
+                if session.last_used is None:
+                    continue
+                if now - session.last_used > self.max_idle:
+                    continue
+                if now - session.last_activity() < self.interval:
+                    continue
+                session.keepalive()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Shared PC/SC context for PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from threading import RLock
+from time import monotonic, sleep
+
+try:
+    from smartcard.scard import (
+        SCardEstablishContext,
+        SCardReleaseContext,
+        SCardListReaders,
+        SCardGetStatusChange,
+        SCardGetErrorMessage,
+        SCARD_SCOPE_USER,
+        SCARD_S_SUCCESS,
+        SCARD_STATE_UNAWARE,
+        SCARD_STATE_CHANGED,
+        SCARD_STATE_PRESENT,
+        SCARD_STATE_UNKNOWN,
+        SCARD_E_TIMEOUT,
+        SCARD_E_NO_SERVICE,
+        SCARD_E_SERVICE_STOPPED,
+        SCARD_E_INVALID_HANDLE,
+        SCARD_E_NO_READERS_AVAILABLE,
+        SCARD_E_UNKNOWN_READER,
+    )
+except ModuleNotFoundError as exc:
+    raise ModuleNotFoundError("pyscard not installed or was not found") from exc
+from lib.piv.piv_card import PIVCardTimeoutException, ConnectionException
+from lib.metrics import metrics
+
+
+# Pseudo reader notifying the readers plugged and removed
+PNP_NOTIFICATION = "\\\\?PnP?\\Notification"
+
+# Errors when the PC/SC service was stopped or restarted
+SERVICE_LOST = (SCARD_E_NO_SERVICE, SCARD_E_SERVICE_STOPPED, SCARD_E_INVALID_HANDLE)
+
+
+class PCSCContext:
+    """PC/SC context, with the readers list in cache
+
+    The context is established once, and again only after the PC/SC
+    service was stopped or restarted. The readers list is read again
+    after a readers change notification.
+    PC/SC doesn't allow concurrent calls on a context, so each card
+    session has its own context, used under the session lock. They
+    share the readers list of the process-wide context, given as
+    readers_source.
+    """
+
+    def __init__(self, readers_source=None):
+        self.lock = RLock()
+        self.hcontext = None
+        self.readers = None
+        self.readers_source = readers_source
+        self.pnp_supported = True
+
+    def get(self):
+        """PC/SC context handle, established if needed"""
+        with self.lock:
+            if self.hcontext is None:
+                hresult, hcontext = SCardEstablishContext(SCARD_SCOPE_USER)
+                if hresult == SCARD_E_NO_SERVICE:
+                    raise ConnectionException("Can't start Scard service")
+                if hresult != SCARD_S_SUCCESS:
+                    raise ConnectionException(SCardGetErrorMessage(hresult))
+                self.hcontext = hcontext
+                self.readers = None
+                metrics.count("pcsc_contexts")
+            return self.hcontext
+
+    def release(self):
+        with self.lock:
+            if self.hcontext is not None:
+                SCardReleaseContext(self.hcontext)
+                self.hcontext = None
+                self.readers = None
+
+    def service_lost(self, hresult):
+        """Is the service lost ? Then the next call establishes a new context"""
+        if hresult in SERVICE_LOST:
+            self.release()
+            return True
+        return False
+
+    def list_readers(self):
+        """PC/SC readers names"""
+        if self.readers_source is not None:
+            return self.readers_source.list_readers()
+        with self.lock:
+            if self.readers is None:
+                hresult, readers = SCardListReaders(self.get(), [])
+                if self.service_lost(hresult):
+                    hresult, readers = SCardListReaders(self.get(), [])
+                if hresult == SCARD_E_NO_READERS_AVAILABLE:
+                    readers = []
+                elif hresult != SCARD_S_SUCCESS:
+                    raise ConnectionException(SCardGetErrorMessage(hresult))
+                self.readers = list(readers)
+                metrics.count("pcsc_list_readers")
+            return list(self.readers)
+
+    def readers_changed(self):
+        """A reader was plugged or removed, the list is read again when needed"""
+        if self.readers_source is not None:
+            self.readers_source.readers_changed()
+            return
+        with self.lock:
+            self.readers = None
+
+    def wait_card(self, timeout, card_match, reader=None):
+        """Wait for a matching card, returns its reader name
+
+        card_match(atr) tells if the card inserted is one to use.
+        Only the given reader is watched, all the readers when None.
+        Raises PIVCardTimeoutException after timeout seconds.
+        """
+        deadline = monotonic() + timeout
+        # States known by the application, unaware at first
+        states = {}
+        rounds = 0
+        while True:
+            if rounds and monotonic() >= deadline:
+                raise PIVCardTimeoutException
+            rounds += 1
+            readers = [reader] if reader else self.list_readers()
+            watched = [
+                name
+                for name in readers
+                if not states.get(name, 0) & SCARD_STATE_UNKNOWN
+            ]
+            if self.pnp_supported:
+                watched.append(PNP_NOTIFICATION)
+            remaining_ms = max(0, int((deadline - monotonic()) * 1000))
+            if not watched:
+                # No reader, and no readers change notification
+                sleep(min(0.25, remaining_ms / 1000))
+                self.readers_changed()
+                states.clear()
+                continue
+            hresult, new_states = SCardGetStatusChange(
+                self.get(),
+                remaining_ms,
+                [(name, states.get(name, SCARD_STATE_UNAWARE)) for name in watched],
+            )
+            if hresult == SCARD_E_TIMEOUT:
+                raise PIVCardTimeoutException
+            if hresult == SCARD_E_UNKNOWN_READER:
+                # Reader removed since the list was read
+                self.readers_changed()
+                states.clear()
+                continue
+            if self.service_lost(hresult):
+                states.clear()
+                continue
+            if hresult != SCARD_S_SUCCESS:
+                raise ConnectionException(SCardGetErrorMessage(hresult))
+            for name, event_state, atr in new_states:
+                if name == PNP_NOTIFICATION:
+                    if event_state & SCARD_STATE_UNKNOWN:
+                        self.pnp_supported = False
+                    elif (
+                        event_state & SCARD_STATE_CHANGED and PNP_NOTIFICATION in states
+                    ):
+                        self.readers_changed()
+                elif event_state & SCARD_STATE_PRESENT and card_match(atr):
+                    return name
+                states[name] = event_state & ~SCARD_STATE_CHANGED
+
+
+# Process-wide PC/SC context, for the readers list
+pcsc_context = PCSCContext()
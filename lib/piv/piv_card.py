@@ -15,17 +15,11 @@
 
 
 import time
+from collections import OrderedDict
 from hashlib import sha256, sha384
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-
-try:
-    from smartcard.CardRequest import CardRequest
-    from smartcard.util import toBytes, toHexString
-    from smartcard.Exceptions import CardRequestTimeoutException, CardConnectionException
-    from smartcard.pcsc.PCSCExceptions import EstablishContextException
-except ModuleNotFoundError as exc:
-    raise ModuleNotFoundError("pyscard not installed or was not found") from exc
 from lib.piv.compat_devices import COMPATIBLE_CARDS_ATR
+from lib.piv.device_profiles import device_profiles, device_id
+from lib.metrics import metrics
 
 
 # Exception classes for PIVcard
@@ -52,6 +46,10 @@ class ConnectionException(PIVBaseException):
     pass
 
 
+class CardResetException(ConnectionException):
+    pass
+
+
 class BadInputException(PIVBaseException):
     pass
 
@@ -102,10 +100,6 @@ def check_hex(func):
     return func_wrapper
 
 
-def to_list(binstr):
-    return toBytes(binstr.hex())
-
-
 def print_list(liststr):
     for item in liststr:
         print(f" - {item}")
@@ -176,30 +170,203 @@ def decode_do(data, start_index):
     return tag, i + len_data, data_read
 
 
-def encode_do(do_data):
-    """Add length header to data"""
-    do_len = len(do_data)
+def read_tlv_header(buffer, idx):
+    """Read a BER tag and length at idx, returns tag, value start and end"""
+    end = len(buffer)
+    tag = buffer[idx]
+    if tag & 0x1F != 0x1F and idx + 1 < end and buffer[idx + 1] < 0x80:
+        # Fast path for the usual 1 byte tag and short length
+        start = idx + 2
+        if start + buffer[idx + 1] > end:
+            raise DataException("BER data out of bounds")
+        return tag, start, start + buffer[idx + 1]
+    idx += 1
+    if tag & 0x1F == 0x1F:
+        # Multi-bytes tag, continues while b8 is set
+        while True:
+            if idx >= end:
+                raise DataException("Truncated BER tag")
+            tag = (tag << 8) | buffer[idx]
+            idx += 1
+            if not buffer[idx - 1] & 0x80:
+                break
+    if idx >= end:
+        raise DataException("Missing BER length")
+    len_data = buffer[idx]
+    idx += 1
+    if len_data & 0x80:
+        # Composed len
+        len_len = len_data & 0x7F
+        if len_len == 0 or len_len > 4 or idx + len_len > end:
+            raise DataException("Invalid BER length")
+        len_data = int.from_bytes(buffer[idx : idx + len_len], "big")
+        idx += len_len
+    if idx + len_data > end:
+        raise DataException("BER data out of bounds")
+    return tag, idx, idx + len_data
+
+
+def tlv_get(buffer, tag):
+    """Value of the first data object with the tag in a memoryview, or None"""
+    idx = 0
+    end = len(buffer)
+    while idx < end:
+        item_tag, start, idx = read_tlv_header(buffer, idx)
+        if item_tag == tag:
+            return buffer[start:idx]
+    return None
+
+
+class TLV:
+    """Lazy BER-TLV reader over a memoryview
+
+    Nothing is decoded nor copied until a tag is looked up,
+    values are returned as memoryview slices of the initial buffer.
+    """
+
+    __slots__ = ("buffer",)
+
+    def __init__(self, data):
+        self.buffer = memoryview(data)
+
+    def __iter__(self):
+        """Iterate over (tag, value) of this level"""
+        buffer = self.buffer
+        idx = 0
+        end = len(buffer)
+        while idx < end:
+            tag, start, idx = read_tlv_header(buffer, idx)
+            yield tag, buffer[start:idx]
+
+    def get(self, tag, default=None):
+        """Value of the first data object with the tag, at this level"""
+        value = tlv_get(self.buffer, tag)
+        if value is None:
+            return default
+        return value
+
+    def get_all(self, tag):
+        """Values of all the data objects with the tag, at this level"""
+        return [value for item_tag, value in self if item_tag == tag]
+
+    def find(self, *tags):
+        """Value at a path of nested tags, such as find(0x7C, 0x82)"""
+        value = self.buffer
+        for tag in tags:
+            value = tlv_get(value, tag)
+            if value is None:
+                return None
+        return value
+
+    def __getitem__(self, tag):
+        value = self.get(tag)
+        if value is None:
+            raise KeyError(f"{tag:02X}")
+        return value
+
+    def __contains__(self, tag):
+        return self.get(tag) is not None
+
+
+def encode_len(do_len):
+    """BER length header for a data of do_len bytes"""
     if do_len < 128:
-        return [do_len, *do_data]
+        return bytes((do_len,))
     if do_len < 256:
-        return [0x81, do_len, *do_data]
+        return bytes((0x81, do_len))
     if do_len < 65536:
-        return [0x82, do_len >> 8, do_len % 256, *do_data]
+        return bytes((0x82, do_len >> 8, do_len & 0xFF))
     raise BadInputException("Data too long.")
 
 
-PIV_AID = "A0 00 00 03 08 00 00 10 00 01 00"
-
+def encode_do(do_data):
+    """Add length header to data"""
+    return encode_len(len(do_data)) + bytes(do_data)
+
+
+def atr_historical_bytes(atr):
+    """Extract the historical bytes from an ATR, ISO 7816-3 8.2"""
+    hist_len = atr[1] & 0x0F
+    idx = 1
+    while True:
+        # Interface bytes present, given by the Y nibble of T0 or TDi
+        num_ifbytes = bin(atr[idx] >> 4).count("1")
+        if not atr[idx] & 0x80:
+            break
+        # TDi is the last interface byte of the group
+        idx += num_ifbytes
+    start = idx + num_ifbytes + 1
+    return atr[start : start + hist_len]
+
+
+def atr_extended_length(atr):
+    """Does the ATR card capabilities advertise extended Lc and Le fields ?"""
+    # ISO 7816-4 8.1.1.2.7
+    hist_bytes = atr_historical_bytes(atr)
+    if not hist_bytes or hist_bytes[0] not in (0x00, 0x80):
+        return False
+    idx = 1
+    while idx < len(hist_bytes):
+        tag = hist_bytes[idx] >> 4
+        len_obj = hist_bytes[idx] & 0x0F
+        if tag == 7 and len_obj >= 3:
+            return bool(hist_bytes[idx + 3] & 0x40)
+        idx += 1 + len_obj
+    return False
+
+
+def atr_is_yubikey(atr):
+    """Does the ATR name a Yubikey ?"""
+    # The Yubikey ATRs carry "Yubikey" in the historical bytes
+    return b"yubikey" in bytes(atr).lower()
 
-class CardsATRList:
-    """A kind of CardType class to use a list of different possibles ATRs"""
 
-    def __init__(self, atr_list):
-        """Initialize the card type with a list of ATR"""
-        self.atrs_list = atr_list
+PIV_AID = "A0 00 00 03 08 00 00 10 00 01 00"
 
-    def matches(self, atr, reader=None):
-        return atr in self.atrs_list
+# Static APDUs
+APDU_SELECT_PIV = bytes.fromhex("00 A4 04 00 0B" + PIV_AID)
+APDU_GET_RESPONSE = bytes.fromhex("00 C0 00 00 00")
+
+# Commands headers
+CMD_GET_DATA = bytes.fromhex("00 CB 3F FF")
+CMD_PUT_DATA = bytes.fromhex("00 DB 3F FF")
+CMD_GET_VERSION = bytes.fromhex("00 FD 00 00")
+CMD_GET_SERIAL = bytes.fromhex("00 F8 00 00")
+CMD_RESET = bytes.fromhex("00 FB 00 00")
+INS_GEN_AUTH = 0x87
+INS_GEN_ASYM = 0x47
+INS_VERIFY = 0x20
+INS_GET_METADATA = 0xF7
+
+# Status of a command sent while another applet is selected,
+# by another application sharing the card
+SW_APPLET_NOT_SELECTED = (0x6D00, 0x6E00)
+
+# Yubico key policies of the generate asymmetric template
+# PIN policy, tag AA
+PIN_POLICIES = {"default": 0, "never": 1, "once": 2, "always": 3}
+# Touch policy, tag AB, "cached" touch is valid 15 seconds
+TOUCH_POLICIES = {"default": 0, "never": 1, "always": 2, "cached": 3}
+
+# Maximum data length in an extended length APDU
+EXTENDED_MAX_DATA = 65535
+
+# Data objects kept in the card data cache, least recently used dropped
+# All the 24 key slots certificates fit
+DATA_CACHE_SIZE = 32
+
+# Key slots and their certificate data object
+# NIST 800-73-4 Part 1 Table 3 and Table 4b
+KEY_SLOTS_CERTS = {
+    0x9A: "5FC105",  # PIV Authentication
+    0x9C: "5FC10A",  # Digital Signature
+    0x9D: "5FC10B",  # Key Management
+    0x9E: "5FC101",  # Card Authentication
+}
+# 20 retired Key Management slots 82-95, certificates 5FC10D-5FC120
+for retired_slot in range(0x82, 0x96):
+    KEY_SLOTS_CERTS[retired_slot] = "5FC1%02X" % (retired_slot - 0x82 + 0x0D)
+del retired_slot
 
 
 # Algorithms constants
@@ -226,39 +393,54 @@ ALG_ECP384_SHA384 = 0xF4
 
 class PIVcard:
 
-    AppID = toBytes(PIV_AID)
-    compat_cards = [toBytes(atr) for atr in COMPATIBLE_CARDS_ATR]
-
-    def __init__(self, connect_timeout, debug=False):
+    compat_cards = [list(bytes.fromhex(atr)) for atr in COMPATIBLE_CARDS_ATR]
+
+    def __init__(
+        self,
+        connect_timeout,
+        debug=False,
+        transport=None,
+        reader=None,
+        share_mode="shared",
+        disposition="leave",
+        context=None,
+    ):
+        """Connect to a PIV device, through PC/SC when no transport is given"""
+        # reader : PC/SC reader name, None for the first device found
+        # share_mode, disposition : PC/SC connection modes, see transport
+        # context : PCSCContext of the connection, see transport
         self.debug = debug
-        piv_card_atr = CardsATRList(PIVcard.compat_cards)
-        try:
-            cardrequest = CardRequest(timeout=connect_timeout, cardType=piv_card_atr)
-            self.cardservice = cardrequest.waitforcard()
-        except CardRequestTimeoutException:
-            raise PIVCardTimeoutException
-        except EstablishContextException as exc:
-            if (
-                str(exc) == "'Failure to establish context:"
-                "The Smart Card Resource Manager is not running. '"
-            ):
-                raise ConnectionException("Can't start Scard service")
-            raise exc
-        except CardConnectionException as exc:
-            raise ConnectionException(str(exc))
-        self.cardservice.connection.connect()
-        time.sleep(0.25)
-        apdu_select = [
-            0x00,
-            0xA4,
-            0x04,
-            0x00,
-            len(PIVcard.AppID),
-        ] + PIVcard.AppID
-        select_resp, sw_byte1, sw_byte2 = self.send_apdu(apdu_select)
+        if transport is None:
+            from lib.piv.transport import PCSCTransport
+
+            transport = PCSCTransport(
+                connect_timeout,
+                PIVcard.compat_cards,
+                reader,
+                share_mode,
+                disposition,
+                context,
+            )
+        self.transport = transport
+        self.extended_length = False
+        # Round trip time of the last APDU sent, in ms
+        self.last_apdu_ms = 0.0
+        time.sleep(self.transport.settle_time)
+        self.select_applet()
+        time.sleep(self.transport.settle_time)
+
+    def select_applet(self):
+        """Select the PIV applet and read the device information"""
+        self.extended_length = False
+        # The card may have been changed since the data were read
+        self.data_cache = OrderedDict()
+        select_resp, sw_byte1, sw_byte2 = self.send_apdu(APDU_SELECT_PIV)
         if sw_byte1 != 0x90 or sw_byte2 != 0x00:
             raise PIVCardException(sw_byte1, sw_byte2)
-        card_info = decode_dol(select_resp)["61"]
+        card_info = TLV(select_resp).find(0x61)
+        if card_info is None:
+            raise DataException("Bad data received from Select command")
+        card_info = TLV(card_info)
         self.label = ""
         self.url_spec = ""
         self.algos = []
@@ -267,21 +449,38 @@ class PIVcard:
         self.yubi_version = ""
         self.yubi_serial = 0
         self.is_yubico = False
-        if card_info.get("50"):
-            self.label = card_info["50"].decode("utf8")
-        if card_info.get("AC"):
-            self.algos = [ord(v) for v in card_info["AC"]["80"]]
+        if card_info.get(0x50):
+            self.label = str(card_info[0x50], "utf8")
+        if card_info.get(0xAC):
+            self.algos = [alg[0] for alg in TLV(card_info[0xAC]).get_all(0x80) if alg]
         if self.algos and ((ALG_CS2 in self.algos) or (ALG_CS7 in self.algos)):
             self.sm_capable = True
         if ALG_ECP256_SHA256 in self.algos:
             self.hash_on_card = True
-        self.yubi_version = self.yubi_get_version()
-        self.is_yubico = bool(self.yubi_version)
-        if self.is_yubico:
+        self.device_id = ""
+        profile = None
+        if device_profiles.file_path and self.atr_is_yubikey():
+            # The serial number validates the known device profile,
+            # only asked to a Yubikey, the other devices don't have it
             try:
                 self.yubi_serial = self.get_serial()
             except PIVCardException:
                 pass
+            # Without serial, the devices of a model can't be told apart
+            if self.yubi_serial:
+                self.device_id = device_id(self.transport.get_atr(), self.yubi_serial)
+                profile = device_profiles.get(self.device_id)
+            if profile and (profile["label"], profile["algos"]) != (
+                self.label,
+                self.algos,
+            ):
+                profile = None
+        if profile:
+            self.yubi_version = profile["yubi_version"]
+            self.is_yubico = bool(self.yubi_version)
+            self.extended_length = profile["extended_length"]
+        else:
+            self.read_device_info()
         if self.debug:
             print("PIV key connected :", self.label)
             if self.is_yubico:
@@ -296,86 +495,206 @@ class PIVcard:
                     )
             print(" Algorithms supported :", [f"0x{alg:02X}" for alg in self.algos])
             print(" Secure Messaging capable ?", "yes" if self.sm_capable else "no")
-        time.sleep(0.25)
+            print(" Extended length APDU ?", "yes" if self.extended_length else "no")
+            if profile:
+                print(" Device profile from cache")
 
-    def __del__(self):
+    def read_device_info(self):
+        """Read the Yubico version and serial, record the device profile"""
+        self.yubi_version = self.yubi_get_version()
+        self.is_yubico = bool(self.yubi_version)
+        if self.is_yubico and not self.yubi_serial:
+            try:
+                self.yubi_serial = self.get_serial()
+            except PIVCardException:
+                pass
+        self.extended_length = self.detect_extended_length()
+        if self.device_id:
+            device_profiles.put(
+                self.device_id,
+                {
+                    "label": self.label,
+                    "algos": self.algos,
+                    "yubi_version": self.yubi_version,
+                    "extended_length": self.extended_length,
+                },
+            )
+
+    def atr_is_yubikey(self):
+        """Is the device a Yubikey, from its ATR ?"""
+        try:
+            return atr_is_yubikey(self.transport.get_atr())
+        except ConnectionException:
+            return False
+
+    def detect_extended_length(self):
+        """Extended length APDU capability, from ATR or Yubikey 4+ version"""
+        if self.is_yubico and int(self.yubi_version.split(".")[0]) >= 4:
+            return True
+        try:
+            return atr_extended_length(self.transport.get_atr())
+        except (ConnectionException, IndexError):
+            return False
+
+    def reconnect(self):
+        """Reconnect after a card reset, and select again the PIV applet"""
+        self.transport.reconnect()
+        self.select_applet()
+
+    def disconnect(self):
         """Disconnect device"""
-        if hasattr(self, "cardservice"):
-            self.cardservice.connection.disconnect()
-            del self.cardservice
+        if hasattr(self, "transport"):
+            self.transport.disconnect()
+            del self.transport
+
+    def __del__(self):
+        self.disconnect()
+
+    def transmit(self, apdu):
+        """Low level transmit, card lost errors are raised as ConnectionException"""
+        return self.transport.transmit(apdu)
 
     def send_apdu(self, apdu):
-        """Send APDU. apdu is a list of integers (uint 8 array/list)"""
+        """Send APDU. apdu is bytes, returns (bytes data, sw_byte1, sw_byte2)"""
         # [ INS, CLA, param_1, param_2, Len, data... ]
         if self.debug:
             print(f" Sending 0x{apdu[1]:X} command with {(len(apdu) - 5)} bytes data")
-            print(f"-> {toHexString(apdu)}")
-            t_env = time.time()
-        data, sw_byte1, sw_byte2 = self.cardservice.connection.transmit(apdu)
+            print(f"->{to_hex_list(apdu)}")
+        t_env = time.perf_counter()
+        data, sw_byte1, sw_byte2 = self.transmit(apdu)
+        t_ans = (time.perf_counter() - t_env) * 1000
+        self.last_apdu_ms = t_ans
+        # Card and reader time, per instruction
+        metrics.observe("apdu_%02X" % apdu[1], t_ans)
         if self.debug:
-            t_ans = (time.time() - t_env) * 1000
             print(
                 " Received %i bytes data : SW 0x%02X%02X - duration: %.1f ms"
                 % (len(data), sw_byte1, sw_byte2, t_ans)
             )
             if len(data) > 0:
-                print(f"<- {toHexString(data)}")
+                print(f"<-{to_hex_list(data)}")
         return data, sw_byte1, sw_byte2
 
     def send_command(self, cmdh, data):
-        """data can be int list or bytesarray"""
-        i = 0
-        lendata = len(data)
-        if isinstance(data, list):
-            full_data = bytes(data)
-        else:  # bytes or bytearray
-            full_data = data
-        data_block_size = 247
-        while lendata > data_block_size:
-            data_apdu = full_data[i : i + data_block_size]
-            apdu_command = cmdh + [len(data_apdu)] + to_list(data_apdu)
-            apdu_command[0] |= 0x10
-            self.send_apdu(apdu_command)
-            i += data_block_size
-            lendata -= data_block_size
-        data_apdu = full_data[i:]
-        apdu_command = cmdh + [len(data_apdu)] + to_list(data_apdu)
-        datar, sw_byte1, sw_byte2 = self.send_apdu(apdu_command)
+        """cmdh is the 4 bytes header, data is a bytes-like object"""
+        cmdh = bytes(cmdh)
+        if self.extended_length and len(data) <= EXTENDED_MAX_DATA:
+            datar, sw_byte1, sw_byte2 = self.send_extended(cmdh, data)
+            if sw_byte1 == 0x67 and sw_byte2 == 0x00:
+                if self.debug:
+                    print(" Extended length rejected, fallback to command chaining")
+                self.extended_length = False
+                datar, sw_byte1, sw_byte2 = self.send_chained(cmdh, data)
+        else:
+            datar, sw_byte1, sw_byte2 = self.send_chained(cmdh, data)
+        if sw_byte1 == 0x61:
+            datar = bytearray(datar)
         while sw_byte1 == 0x61:
             if self.debug:
                 t_env = time.time()
-            datacompl, sw_byte1, sw_byte2 = self.cardservice.connection.transmit(
-                [0x00, 0xC0, 0, 0, 0]
-            )
+            datacompl, sw_byte1, sw_byte2 = self.transmit(APDU_GET_RESPONSE)
             if self.debug:
                 t_ans = int((time.time() - t_env) * 10000) / 10.0
                 print(
                     " Received remaining %i bytes : 0x%02X%02X - duration: %.1f ms"
                     % (len(datacompl), sw_byte1, sw_byte2, t_ans)
                 )
-                print(f"<- {toHexString(datacompl)}")
+                print(f"<-{to_hex_list(datacompl)}")
             datar += datacompl
         if sw_byte1 == 0x63 and sw_byte2 & 0xF0 == 0xC0:
             raise PinException(sw_byte2 - 0xC0)
         if sw_byte1 != 0x90 or sw_byte2 != 0x00:
             raise PIVCardException(sw_byte1, sw_byte2)
-        return datar
+        return bytes(datar)
+
+    def send_chained(self, cmdh, data):
+        """Send data in short APDUs, with command chaining"""
+        i = 0
+        lendata = len(data)
+        full_data = memoryview(data)
+        cmdh_chained = bytes((cmdh[0] | 0x10,)) + cmdh[1:]
+        data_block_size = 247
+        block_len = bytes((data_block_size,))
+        while lendata > data_block_size:
+            data_apdu = full_data[i : i + data_block_size]
+            self.send_apdu(b"".join((cmdh_chained, block_len, data_apdu)))
+            i += data_block_size
+            lendata -= data_block_size
+        data_apdu = full_data[i:]
+        apdu_command = b"".join((cmdh, bytes((len(data_apdu),)), data_apdu))
+        return self.send_apdu(apdu_command)
+
+    def send_extended(self, cmdh, data):
+        """Send data in a single extended length APDU, with Le for 65536 bytes"""
+        if data:
+            apdu_command = b"".join(
+                (cmdh, b"\x00", len(data).to_bytes(2, "big"), data, b"\x00\x00")
+            )
+        else:
+            apdu_command = cmdh + b"\x00\x00\x00"
+        return self.send_apdu(apdu_command)
 
     def yubi_get_version(self):
         """Yubico extension"""
-        version_command = [0x00, 0xFD, 0x00, 0x00]
         try:
-            version_bin = self.send_command(version_command, b"")
+            version_bin = self.send_command(CMD_GET_VERSION, b"")
             if len(version_bin) < 3:
                 return ""
             return ".".join([str(c) for c in version_bin])
         except PIVCardException:
             return ""
 
+    def ping(self):
+        """Cheap command without side effect, to keep the device awake"""
+        if self.is_yubico:
+            return self.send_command(CMD_GET_VERSION, b"")
+        # Discovery object
+        try:
+            return self.read_data("7E")
+        except (PIVCardException, DataException):
+            return b""
+
+    def has_metadata(self):
+        """Yubico GET METADATA is available from version 5.3"""
+        if not self.is_yubico:
+            return False
+        version = tuple(int(num) for num in self.yubi_version.split(".")[:2])
+        return version >= (5, 3)
+
+    def get_metadata(self, keyref):
+        """Yubico extension, metadata TLV of a key slot"""
+        # 01 algorithm, 02 PIN and touch policies, 03 origin, 04 public key
+        apdu_command = bytes((0x00, INS_GET_METADATA, 0x00, keyref))
+        return TLV(self.send_command(apdu_command, b""))
+
+    def get_public_key(self, keyref):
+        """EC public key point of a key slot, from its Yubico metadata"""
+        pubkey_do = self.get_metadata(keyref).get(0x04)
+        if pubkey_do is None or 0x86 not in TLV(pubkey_do):
+            raise DataException("No EC public key in the slot metadata")
+        return bytes(TLV(pubkey_do)[0x86])
+
+    def get_key_policy(self, keyref):
+        """PIN and touch policies names of a key slot, None if unknown
+
+        From the Yubico metadata when available, else as recorded in the
+        device profile when the key was generated.
+        """
+        if self.has_metadata():
+            policies = self.get_metadata(keyref).get(0x02)
+            if policies is None or len(policies) != 2:
+                return None
+            pin_names = {value: name for name, value in PIN_POLICIES.items()}
+            touch_names = {value: name for name, value in TOUCH_POLICIES.items()}
+            return {
+                "pin": pin_names.get(policies[0], "default"),
+                "touch": touch_names.get(policies[1], "default"),
+            }
+        return device_profiles.get_policy(self.device_id, keyref)
+
     def get_serial(self):
         """Yubico extension, only available on Yubikey 5"""
-        serial_command = [0x00, 0xF8, 0x00, 0x00]
-        serial_bin = self.send_command(serial_command, b"")
+        serial_bin = self.send_command(CMD_GET_SERIAL, b"")
         try:
             return int.from_bytes(serial_bin, "big")
         except PIVCardException:
@@ -383,17 +702,13 @@ class PIVcard:
 
     def reset(self):
         """PIV extension, only available when both PIN and PUK are blocked."""
-        reset_command = [0x00, 0xFB, 0x00, 0x00]
-        return self.send_command(reset_command, b"")
+        self.data_cache.clear()
+        device_profiles.drop_keys(self.device_id, policies=True)
+        return self.send_command(CMD_RESET, b"")
 
     def general_authenticate(self, algo, keyref, data_auth):
-        apdu_command = [
-            0x00,
-            0x87,
-            algo,
-            keyref,
-        ]
-        data = [0x7C, *encode_do(data_auth)]
+        apdu_command = bytes((0x00, INS_GEN_AUTH, algo, keyref))
+        data = b"".join((b"\x7C", encode_len(len(data_auth)), data_auth))
         return self.send_command(apdu_command, data)
 
     def sign_ec(self, algo, keyref, message):
@@ -413,16 +728,22 @@ class PIVcard:
             else:
                 raise BadInputException("EC sign shall be ECP256 0x11 or ECP384 0x14")
         # Response null, Challenge Hash/Data
-        data = [0x82, 0x00, 0x81, *encode_do(hash_data)]
-        return decode_dol(self.general_authenticate(algo, keyref, data))["7C"]["82"]
+        data = b"".join((b"\x82\x00\x81", encode_len(len(hash_data)), hash_data))
+        signature = TLV(self.general_authenticate(algo, keyref, data)).find(0x7C, 0x82)
+        if signature is None:
+            raise DataException("Bad data received from General Authenticate command")
+        return bytes(signature)
 
     def external_auth_admin(self, key_ref, keyalgo, auth_key):
         # keyalgo : See NIST 800-78-4 6.2 & 6.3
         # auth_type = 0x81 # challenge - See PIV NIST 800-73-4 3.2.4 Table 7
-        chall_resp = self.general_authenticate(keyalgo, key_ref, [0x81, 0])
-        if chall_resp[:4] != [0x7C, 0x0A, 0x81, 8] or len(chall_resp) != 12:
+        chall_resp = self.general_authenticate(keyalgo, key_ref, b"\x81\x00")
+        if chall_resp[:4] != b"\x7C\x0A\x81\x08" or len(chall_resp) != 12:
             raise DataException("Bad data received from External Authenticate command")
-        challenge = bytes(chall_resp[4:])
+        challenge = chall_resp[4:]
+        # Imported here, only the key generation authenticates as admin
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
         # Encrypt challenge (with keyalgo 00/03 TDES)
         enc_algo = algorithms.TripleDES(auth_key)
         mode_algo = modes.ECB()
@@ -430,49 +751,97 @@ class PIVcard:
         encryptor = cipher.encryptor()
         data_enc = encryptor.update(challenge)
         # Response 0x82
-        resp_data = [0x82, *encode_do(data_enc)]
+        resp_data = b"\x82" + encode_do(data_enc)
         # 0x6982 status if rejected
         auth_resp = self.general_authenticate(keyalgo, key_ref, resp_data)
         return auth_resp
 
-    def gen_asymmetric(self, keyref, keyalgo):
-        """Generate a key pair"""
+    def gen_asymmetric(
+        self, keyref, keyalgo, touch_policy="always", pin_policy="default"
+    ):
+        """Generate a key pair, policies are only applied on Yubico devices"""
         # key algo : PIV NIST 800-73-4 Part 1 5.3 Table 5
-        apdu_command = [
-            0x00,
-            0x47,
-            0,
-            keyref,
-        ]
-        data = [0xAC, 3, 0x80, 1, keyalgo]
+        if touch_policy not in TOUCH_POLICIES:
+            raise BadInputException(f"Unknown touch policy {touch_policy}")
+        if pin_policy not in PIN_POLICIES:
+            raise BadInputException(f"Unknown PIN policy {pin_policy}")
+        apdu_command = bytes((0x00, INS_GEN_ASYM, 0, keyref))
+        template = bytes((0x80, 1, keyalgo))
         if self.is_yubico:
-            # Add extention for touch confirmation
-            data[1] = 6
-            data.extend([0xAB, 1, 0x02])
+            # Add extentions for PIN and touch confirmation
+            if PIN_POLICIES[pin_policy]:
+                template += bytes((0xAA, 1, PIN_POLICIES[pin_policy]))
+            if TOUCH_POLICIES[touch_policy]:
+                template += bytes((0xAB, 1, TOUCH_POLICIES[touch_policy]))
+        data = b"\xAC" + encode_do(template)
+        # The slot certificate is no longer the one of the key
+        if keyref in KEY_SLOTS_CERTS:
+            self.invalidate_data(KEY_SLOTS_CERTS[keyref])
+        device_profiles.drop_keys(self.device_id, [keyref], policies=True)
         gen_resp = self.send_command(apdu_command, data)
-        if gen_resp[:2] != [0x7F, 0x49] or len(gen_resp) != gen_resp[2] + 3:
+        if gen_resp[:2] != b"\x7F\x49" or len(gen_resp) != gen_resp[2] + 3:
             raise DataException("Bad data received from Generate Asymmetric command")
+        if self.is_yubico:
+            device_profiles.set_policy(
+                self.device_id, keyref, {"pin": pin_policy, "touch": touch_policy}
+            )
         # if ECC (11 or 14) -> gen_resp[2] == 0x86
         # if ECC384, keyalg = 0x14 -> gen_resp[4]:keylen == 97
         # return public key data, for ECC 86 : 04 ..
-        return decode_dol(gen_resp[3:])
+        return TLV(memoryview(gen_resp)[3:])
 
     def get_data(self, file_tlv_hex):
+        """Binary read / ISO read the object, from the data cache if read before"""
+        file_tlv_hex = file_tlv_hex.upper()
+        data_object = self.data_cache.get(file_tlv_hex)
+        if data_object is not None:
+            self.data_cache.move_to_end(file_tlv_hex)
+            metrics.count("data_cache_hits")
+            if self.debug:
+                print(f"Read Data in 0x{file_tlv_hex} from cache")
+        else:
+            metrics.count("data_cache_misses")
+            try:
+                data_object = self.read_data(file_tlv_hex)
+            except PIVCardException as exc:
+                if exc.sw_code != 0x6A82:
+                    raise
+                # Empty objects are also cached, as their not found status
+                data_object = exc
+            self.data_cache[file_tlv_hex] = data_object
+            if len(self.data_cache) > DATA_CACHE_SIZE:
+                self.data_cache.popitem(last=False)
+        if isinstance(data_object, PIVCardException):
+            raise PIVCardException(data_object.sw_byte1, data_object.sw_byte2)
+        return data_object
+
+    def invalidate_data(self, file_tlv_hex):
+        self.data_cache.pop(file_tlv_hex.upper(), None)
+
+    def forget_keys(self):
+        """Forget the data objects read and the keys of the device profile
+
+        For a read again from the device, its keys may have been changed
+        by another application.
+        """
+        self.data_cache.clear()
+        device_profiles.drop_keys(self.device_id)
+
+    def read_data(self, file_tlv_hex):
         """Binary read / ISO read the object"""
         lenaddr = len(file_tlv_hex) // 2
         data_hex = f"5C{lenaddr:02X}{file_tlv_hex}"
         if self.debug:
             print(f"Read Data in 0x{file_tlv_hex}")
-        apdu_command = [0x00, 0xCB, 0x3F, 0xFF]
         data = bytes.fromhex(data_hex)
-        dataresp = self.send_command(apdu_command, data)
+        dataresp = self.send_command(CMD_GET_DATA, data)
         if lenaddr == 3:
             if dataresp[0] != 0x53:
                 raise DataException("Bad data received from Get Data command")
-            return decode_dol(dataresp)["53"]
+            return bytes(TLV(dataresp)[0x53])
         if lenaddr == 1 and dataresp[0] != int(file_tlv_hex, 16):
             raise DataException("Bad data received from Get Data command")
-        return decode_dol(dataresp)[file_tlv_hex]
+        return bytes(TLV(dataresp)[int(file_tlv_hex, 16)])
 
     def put_data(self, file_tlv_hex, data_bin):
         """Binary write / ISO write the object"""
@@ -481,13 +850,25 @@ class PIVcard:
             print(f"Put Data {data_bin.hex()} in 0x{file_tlv_hex}")
         len_data_bin_b1 = len(data_bin) >> 8
         len_data_bin_b2 = len(data_bin) % 256
-        full_data = (
-            bytes.fromhex(data_hex)
-            + bytes([0x53, 0x82, len_data_bin_b1, len_data_bin_b2])
-            + data_bin
+        full_data = b"".join(
+            (
+                bytes.fromhex(data_hex),
+                bytes((0x53, 0x82, len_data_bin_b1, len_data_bin_b2)),
+                data_bin,
+            )
+        )
+        # Forgotten before the write, which can fail after a first chained part
+        self.invalidate_data(file_tlv_hex)
+        # A new certificate may hold another key
+        device_profiles.drop_keys(
+            self.device_id,
+            [
+                slot
+                for slot, cert_object in KEY_SLOTS_CERTS.items()
+                if cert_object == file_tlv_hex.upper()
+            ],
         )
-        apdu_command = [0x00, 0xDB, 0x3F, 0xFF]
-        self.send_command(apdu_command, full_data)
+        self.send_command(CMD_PUT_DATA, full_data)
 
     def get_pin_status(self, pin_bank):
         """Return remaining tries left for the given PIN bank address"""
@@ -508,6 +889,6 @@ class PIVcard:
             pin_data = pin_string.encode("ascii")
             while len(pin_data) < 8:
                 pin_data += b"\xFF"
-            self.send_command([0, 0x20, 0, pin_bank], pin_data)
+            self.send_command(bytes((0, INS_VERIFY, 0, pin_bank)), pin_data)
         else:
-            self.send_command([0, 0x20, 0, pin_bank], b"")
+            self.send_command(bytes((0, INS_VERIFY, 0, pin_bank)), b"")
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# PC/SC transport for the PIV card layer of PIVageant
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+# A transport is any object providing :
+#  transmit(apdu bytes) -> (data bytes, sw_byte1, sw_byte2)
+#  reconnect() : after a card reset, keeps the card powered
+#  disconnect()
+#  get_atr() -> ATR as int list
+#  settle_time : seconds to wait after connection before the first APDU
+# Card lost errors are raised as ConnectionException,
+# and as CardResetException when the card was reset by another application.
+#
+# The PC/SC share mode is "shared", or "exclusive" so no other application
+# can send commands (or reset the card) while PIVageant is connected.
+# The disposition is what is done to the card at disconnection : "leave"
+# keeps it powered with its state (selected applet, PIN verified), "reset"
+# and "unpower" clear it.
+
+
+try:
+    from smartcard.scard import (
+        SCardConnect,
+        SCardReconnect,
+        SCardDisconnect,
+        SCardTransmit,
+        SCardStatus,
+        SCardGetErrorMessage,
+        SCARD_S_SUCCESS,
+        SCARD_SHARE_SHARED,
+        SCARD_SHARE_EXCLUSIVE,
+        SCARD_PROTOCOL_T0,
+        SCARD_PROTOCOL_T1,
+        SCARD_PCI_T0,
+        SCARD_PCI_T1,
+        SCARD_LEAVE_CARD,
+        SCARD_RESET_CARD,
+        SCARD_UNPOWER_CARD,
+        SCARD_W_RESET_CARD,
+        SCARD_E_SHARING_VIOLATION,
+    )
+except ModuleNotFoundError as exc:
+    raise ModuleNotFoundError("pyscard not installed or was not found") from exc
+from lib.piv.piv_card import (
+    ConnectionException,
+    CardResetException,
+    BadInputException,
+)
+from lib.piv.pcsc_context import pcsc_context
+
+
+PROTOCOLS_PCI = {SCARD_PROTOCOL_T0: SCARD_PCI_T0, SCARD_PROTOCOL_T1: SCARD_PCI_T1}
+
+SHARE_MODES = {"shared": SCARD_SHARE_SHARED, "exclusive": SCARD_SHARE_EXCLUSIVE}
+
+DISPOSITIONS = {
+    "leave": SCARD_LEAVE_CARD,
+    "reset": SCARD_RESET_CARD,
+    "unpower": SCARD_UNPOWER_CARD,
+}
+
+
+def pcsc_error(hresult):
+    """Card lost exception for a PC/SC error code"""
+    if hresult == SCARD_W_RESET_CARD:
+        return CardResetException(SCardGetErrorMessage(hresult))
+    if hresult == SCARD_E_SHARING_VIOLATION:
+        return ConnectionException("PIV device is used by another application")
+    return ConnectionException(SCardGetErrorMessage(hresult))
+
+
+class PCSCTransport:
+    """Transport to a PC/SC reader, in the given PCSCContext"""
+
+    settle_time = 0.25
+
+    def __init__(
+        self,
+        connect_timeout,
+        atr_list,
+        reader=None,
+        share_mode="shared",
+        disposition="leave",
+        context=None,
+    ):
+        # context : PCSCContext used only by this transport thread,
+        # the process-wide context when None
+        if share_mode not in SHARE_MODES:
+            raise BadInputException(f"Unknown share mode {share_mode}")
+        if disposition not in DISPOSITIONS:
+            raise BadInputException(f"Unknown disposition {disposition}")
+        self.share_mode = SHARE_MODES[share_mode]
+        self.disposition = DISPOSITIONS[disposition]
+        self.hcard = None
+        self.context = context or pcsc_context
+        self.reader = self.context.wait_card(
+            connect_timeout, lambda atr: list(atr) in atr_list, reader
+        )
+        hresult, hcard, protocol = SCardConnect(
+            self.context.get(),
+            self.reader,
+            self.share_mode,
+            SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1,
+        )
+        if hresult != SCARD_S_SUCCESS:
+            self.context.service_lost(hresult)
+            raise pcsc_error(hresult)
+        self.hcard = hcard
+        self.protocol = PROTOCOLS_PCI.get(protocol, SCARD_PCI_T1)
+
+    def transmit(self, apdu):
+        if self.hcard is None:
+            raise ConnectionException("Card not connected")
+        hresult, response = SCardTransmit(self.hcard, self.protocol, list(apdu))
+        if hresult != SCARD_S_SUCCESS:
+            raise pcsc_error(hresult)
+        if len(response) < 2:
+            raise ConnectionException("Card returned no valid response")
+        response = bytes(byte & 0xFF for byte in response)
+        return response[:-2], response[-2], response[-1]
+
+    def reconnect(self):
+        if self.hcard is None:
+            raise ConnectionException("Card not connected")
+        hresult, protocol = SCardReconnect(
+            self.hcard,
+            self.share_mode,
+            SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1,
+            SCARD_LEAVE_CARD,
+        )
+        if hresult != SCARD_S_SUCCESS:
+            raise pcsc_error(hresult)
+        self.protocol = PROTOCOLS_PCI.get(protocol, SCARD_PCI_T1)
+
+    def disconnect(self):
+        if self.hcard is not None:
+            SCardDisconnect(self.hcard, self.disposition)
+            self.hcard = None
+
+    def get_atr(self):
+        if self.hcard is None:
+            raise ConnectionException("Card not connected")
+        hresult, _, _, _, atr = SCardStatus(self.hcard)
+        if hresult != SCARD_S_SUCCESS:
+            raise pcsc_error(hresult)
+        return [byte & 0xFF for byte in atr]
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+# Software emulated PIV device for PIVageant
+# to test and benchmark the card layer without hardware
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import time
+from os import urandom
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.serialization import PublicFormat, Encoding
+from lib.piv.compat_devices import COMPATIBLE_CARDS_ATR
+from lib.piv.piv_card import (
+    decode_dol,
+    decode_do,
+    encode_do,
+    ConnectionException,
+    CardResetException,
+    PIV_AID,
+    ALG_3DES,
+    ALG_ECP256,
+    ALG_ECP384,
+    ALG_ECP256_SHA1,
+    ALG_ECP256_SHA256,
+    ALG_ECP384_SHA1,
+    ALG_ECP384_SHA256,
+    ALG_ECP384_SHA384,
+)
+
+DEFAULT_ADMIN_KEY = "010203040506070801020304050607080102030405060708"
+DEFAULT_PIN = "123456"
+YUBIKEY5_ATR = COMPATIBLE_CARDS_ATR[2]
+
+# Status words
+SW_OK = (0x90, 0x00)
+SW_WRONG_LENGTH = (0x67, 0x00)
+SW_SECURITY_STATUS = (0x69, 0x82)
+SW_AUTH_BLOCKED = (0x69, 0x83)
+SW_CONDITIONS = (0x69, 0x85)
+SW_WRONG_DATA = (0x6A, 0x80)
+SW_NOT_FOUND = (0x6A, 0x82)
+SW_INCORRECT_P1P2 = (0x6A, 0x86)
+SW_REF_NOT_FOUND = (0x6A, 0x88)
+SW_INS_NOT_SUPPORTED = (0x6D, 0x00)
+
+# Touch and PIN policies, as Yubico extensions
+TOUCH_NEVER = 0x01
+TOUCH_ALWAYS = 0x02
+TOUCH_CACHED = 0x03
+PIN_NEVER = 0x01
+PIN_ONCE = 0x02
+PIN_ALWAYS = 0x03
+
+HASH_ON_CARD_ALGS = {
+    ALG_ECP256_SHA1: (ALG_ECP256, hashes.SHA1()),
+    ALG_ECP256_SHA256: (ALG_ECP256, hashes.SHA256()),
+    ALG_ECP384_SHA1: (ALG_ECP384, hashes.SHA1()),
+    ALG_ECP384_SHA256: (ALG_ECP384, hashes.SHA256()),
+    ALG_ECP384_SHA384: (ALG_ECP384, hashes.SHA384()),
+}
+PREHASH_BY_LENGTH = {
+    20: hashes.SHA1(),
+    32: hashes.SHA256(),
+    48: hashes.SHA384(),
+}
+CURVES = {
+    ALG_ECP256: ec.SECP256R1(),
+    ALG_ECP384: ec.SECP384R1(),
+}
+
+
+def default_pin_policy(keyref):
+    """PIN policy of a slot, as in PIV NIST 800-73-4 Part 1 3.1"""
+    if keyref == 0x9E:
+        return PIN_NEVER
+    if keyref == 0x9C:
+        return PIN_ALWAYS
+    return PIN_ONCE
+
+
+class VirtualKey:
+    def __init__(self, keyalgo, touch_policy, pin_policy, private_key=None):
+        self.keyalgo = keyalgo
+        self.touch_policy = touch_policy
+        self.pin_policy = pin_policy
+        # Origin in the metadata : 1 generated, 2 imported
+        self.origin = 0x01
+        if private_key is None:
+            private_key = ec.generate_private_key(CURVES[keyalgo])
+        else:
+            self.origin = 0x02
+        self.private_key = private_key
+
+    def public_point(self):
+        return self.private_key.public_key().public_bytes(
+            Encoding.X962, PublicFormat.UncompressedPoint
+        )
+
+
+class VirtualPIVApplet:
+    """In-process PIV applet, processing the APDUs sent by PIVcard"""
+
+    def __init__(
+        self,
+        label="Virtual PIV",
+        yubico_version=(5, 4, 3),
+        serial=10000001,
+        hash_on_card=False,
+        atr=YUBIKEY5_ATR,
+        admin_key=DEFAULT_ADMIN_KEY,
+        pin=DEFAULT_PIN,
+        extended_length=True,
+    ):
+        # yubico_version None emulates a non Yubico device
+        # extended_length False rejects extended APDUs with 6700
+        # serial None emulates a device with its serial hidden
+        self.label = label
+        self.extended_length = extended_length
+        self.yubico_version = yubico_version
+        self.serial = serial
+        self.hash_on_card = hash_on_card
+        self.atr = list(bytes.fromhex(atr))
+        self.admin_key = bytes.fromhex(admin_key)
+        self.pin = pin.encode("ascii").ljust(8, b"\xff")
+        self.pin_retries = 3
+        self.puk_retries = 3
+        self.algos = [ALG_3DES, ALG_ECP256, ALG_ECP384]
+        if hash_on_card:
+            self.algos.extend(HASH_ON_CARD_ALGS)
+        self.keys = {}
+        self.objects = {}
+        # touch_handler(keyref) returns True when the user touched in time
+        self.touch_handler = None
+        self.power_reset()
+
+    def power_reset(self):
+        """Card state after a power cycle or a reset"""
+        self.selected = False
+        self.admin_auth = False
+        self.admin_challenge = None
+        self.pin_verified = False
+        self.touch_cached = False
+        self.chained_data = b""
+        self.pending_response = b""
+
+    def import_key(self, keyref, keyalgo, private_key=None, touch_policy=None):
+        """Load a key in a slot, returns the public key point"""
+        if touch_policy is None:
+            touch_policy = TOUCH_ALWAYS if self.yubico_version else TOUCH_NEVER
+        key = VirtualKey(keyalgo, touch_policy, default_pin_policy(keyref), private_key)
+        self.keys[keyref] = key
+        return key.public_point()
+
+    def process(self, apdu):
+        """Process a command APDU, returns (data, sw_byte1, sw_byte2)"""
+        apdu = bytes(apdu)
+        extended = len(apdu) > 5 and apdu[4] == 0
+        if extended and not self.extended_length:
+            return b"", SW_WRONG_LENGTH[0], SW_WRONG_LENGTH[1]
+        resp, status = self.process_apdu(apdu, extended)
+        if len(resp) > 256 and not extended:
+            self.pending_response = resp[256:]
+            remaining = min(len(self.pending_response), 256) & 0xFF
+            return resp[:256], 0x61, remaining
+        return resp, status[0], status[1]
+
+    def process_apdu(self, apdu, extended=False):
+        if len(apdu) < 4:
+            return b"", SW_WRONG_LENGTH
+        cla, ins, param_1, param_2 = apdu[:4]
+        data = b""
+        if extended:
+            # Extended length : 00 Lc1 Lc2 data Le1 Le2, or 00 Le1 Le2
+            if len(apdu) > 7:
+                len_data = int.from_bytes(apdu[5:7], "big")
+                data = apdu[7 : 7 + len_data]
+                if len(data) != len_data:
+                    return b"", SW_WRONG_LENGTH
+        elif len(apdu) > 5:
+            data = apdu[5 : 5 + apdu[4]]
+            if len(data) != apdu[4]:
+                return b"", SW_WRONG_LENGTH
+        if ins == 0xC0:
+            return self.get_response()
+        self.pending_response = b""
+        if cla & 0x10:
+            self.chained_data += data
+            return b"", SW_OK
+        data = self.chained_data + data
+        self.chained_data = b""
+        if ins == 0xA4:
+            return self.select(param_1, data)
+        if not self.selected:
+            return b"", SW_INS_NOT_SUPPORTED
+        if ins == 0xCB:
+            return self.get_data(param_1, param_2, data)
+        if ins == 0xDB:
+            return self.put_data(param_1, param_2, data)
+        if ins == 0x47:
+            return self.generate_asymmetric(param_2, data)
+        if ins == 0x87:
+            return self.general_authenticate(param_1, param_2, data)
+        if ins == 0x20:
+            return self.verify(param_2, data)
+        if ins == 0xFB:
+            return self.reset()
+        if self.yubico_version:
+            if ins == 0xFD:
+                return bytes(self.yubico_version), SW_OK
+            if ins == 0xF8 and self.serial is not None:
+                return self.serial.to_bytes(4, "big"), SW_OK
+            if ins == 0xF7 and tuple(self.yubico_version) >= (5, 3):
+                return self.get_metadata(param_2)
+        return b"", SW_INS_NOT_SUPPORTED
+
+    def get_response(self):
+        resp = self.pending_response[:256]
+        self.pending_response = self.pending_response[256:]
+        if self.pending_response:
+            return resp, (0x61, min(len(self.pending_response), 256) & 0xFF)
+        return resp, SW_OK
+
+    def select(self, param_1, data):
+        if param_1 != 0x04 or not data or data != bytes.fromhex(PIV_AID)[: len(data)]:
+            self.selected = False
+            return b"", SW_NOT_FOUND
+        self.selected = True
+        pix = bytes.fromhex(PIV_AID)[5:]
+        app_info = b"\x4f" + encode_do(pix)
+        app_info += bytes([0x79, 7, 0x4F, 5]) + bytes.fromhex(PIV_AID)[:5]
+        if self.label:
+            app_info += b"\x50" + encode_do(self.label.encode("utf8"))
+        algos_list = b"".join(bytes([0x80, 1, alg]) for alg in self.algos)
+        algos_list += b"\x06\x00"
+        app_info += b"\xac" + encode_do(algos_list)
+        return b"\x61" + encode_do(app_info), SW_OK
+
+    def get_data(self, param_1, param_2, data):
+        if (param_1, param_2) != (0x3F, 0xFF):
+            return b"", SW_INCORRECT_P1P2
+        try:
+            object_id = decode_dol(data)["5C"]
+        except (KeyError, IndexError):
+            return b"", SW_WRONG_DATA
+        if object_id not in self.objects:
+            return b"", SW_NOT_FOUND
+        content = self.objects[object_id]
+        if len(object_id) == 1:
+            return object_id + encode_do(content), SW_OK
+        return b"\x53" + encode_do(content), SW_OK
+
+    def put_data(self, param_1, param_2, data):
+        if (param_1, param_2) != (0x3F, 0xFF):
+            return b"", SW_INCORRECT_P1P2
+        if not self.admin_auth:
+            return b"", SW_SECURITY_STATUS
+        try:
+            data_objects = decode_dol(data)
+            object_id = data_objects["5C"]
+            content = data_objects["53"]
+        except (KeyError, IndexError):
+            return b"", SW_WRONG_DATA
+        if content:
+            self.objects[object_id] = content
+        else:
+            self.objects.pop(object_id, None)
+        return b"", SW_OK
+
+    def get_metadata(self, keyref):
+        key = self.keys.get(keyref)
+        if key is None:
+            # As a YubiKey 5.3+ for an empty slot
+            return b"", SW_REF_NOT_FOUND
+        metadata = b"".join(
+            (
+                bytes([0x01, 1, key.keyalgo]),
+                bytes([0x02, 2, key.pin_policy, key.touch_policy]),
+                bytes([0x03, 1, key.origin]),
+                b"\x04" + encode_do(b"\x86" + encode_do(key.public_point())),
+            )
+        )
+        return metadata, SW_OK
+
+    def generate_asymmetric(self, keyref, data):
+        if not self.admin_auth:
+            return b"", SW_SECURITY_STATUS
+        # Yubico policy tags AA and AB are not BER constructed
+        template = {}
+        try:
+            tag, _, template_data = decode_do(data, 0)
+            idx = 0
+            while idx < len(template_data):
+                param_tag, idx, param = decode_do(template_data, idx)
+                template[f"{param_tag:02X}"] = param
+            keyalgo = template["80"][0]
+        except (KeyError, IndexError):
+            return b"", SW_WRONG_DATA
+        if tag != 0xAC:
+            return b"", SW_WRONG_DATA
+        if keyalgo not in CURVES:
+            return b"", SW_INCORRECT_P1P2
+        touch_policy = TOUCH_NEVER
+        if self.yubico_version and template.get("AB"):
+            touch_policy = template["AB"][0]
+        key = VirtualKey(keyalgo, touch_policy, default_pin_policy(keyref))
+        if self.yubico_version and template.get("AA"):
+            key.pin_policy = template["AA"][0]
+        self.keys[keyref] = key
+        pubkey_do = b"\x86" + encode_do(key.public_point())
+        return b"\x7f\x49" + encode_do(pubkey_do), SW_OK
+
+    def general_authenticate(self, keyalgo, keyref, data):
+        try:
+            auth_template = decode_dol(data)["7C"]
+        except (KeyError, IndexError):
+            return b"", SW_WRONG_DATA
+        if keyalgo == ALG_3DES and keyref == 0x9B:
+            return self.admin_authenticate(auth_template)
+        return self.sign(keyalgo, keyref, auth_template)
+
+    def admin_authenticate(self, auth_template):
+        self.admin_auth = False
+        if auth_template.get("82") and self.admin_challenge:
+            cipher = Cipher(algorithms.TripleDES(self.admin_key), modes.ECB())
+            encryptor = cipher.encryptor()
+            expected = encryptor.update(self.admin_challenge)
+            self.admin_challenge = None
+            if auth_template["82"] != expected:
+                return b"", SW_SECURITY_STATUS
+            self.admin_auth = True
+            return b"", SW_OK
+        if "81" in auth_template:
+            self.admin_challenge = urandom(8)
+            return bytes([0x7C, 10, 0x81, 8]) + self.admin_challenge, SW_OK
+        return b"", SW_WRONG_DATA
+
+    def sign(self, keyalgo, keyref, auth_template):
+        key = self.keys.get(keyref)
+        if key is None:
+            return b"", SW_REF_NOT_FOUND
+        message = auth_template.get("81")
+        if message is None or "82" not in auth_template:
+            return b"", SW_WRONG_DATA
+        if self.hash_on_card and keyalgo in HASH_ON_CARD_ALGS:
+            keyalgo, hash_algo = HASH_ON_CARD_ALGS[keyalgo]
+            sig_algo = ec.ECDSA(hash_algo)
+        else:
+            if len(message) not in PREHASH_BY_LENGTH:
+                return b"", SW_WRONG_DATA
+            sig_algo = ec.ECDSA(utils.Prehashed(PREHASH_BY_LENGTH[len(message)]))
+        if keyalgo != key.keyalgo:
+            return b"", SW_INCORRECT_P1P2
+        if key.pin_policy != PIN_NEVER and not self.pin_verified:
+            return b"", SW_SECURITY_STATUS
+        if key.pin_policy == PIN_ALWAYS:
+            self.pin_verified = False
+        if not self.touch(key, keyref):
+            return b"", SW_SECURITY_STATUS
+        signature = key.private_key.sign(message, sig_algo)
+        sig_do = b"\x82" + encode_do(signature)
+        return b"\x7c" + encode_do(sig_do), SW_OK
+
+    def touch(self, key, keyref):
+        if key.touch_policy == TOUCH_NEVER:
+            return True
+        if key.touch_policy == TOUCH_CACHED and self.touch_cached:
+            return True
+        touched = self.touch_handler is None or self.touch_handler(keyref)
+        self.touch_cached = touched
+        return touched
+
+    def verify(self, pin_bank, data):
+        if pin_bank != 0x80:
+            return b"", SW_REF_NOT_FOUND
+        if self.pin_retries == 0:
+            return b"", SW_AUTH_BLOCKED
+        if not data:
+            if self.pin_verified:
+                return b"", SW_OK
+            return b"", (0x63, 0xC0 | self.pin_retries)
+        if data != self.pin:
+            self.pin_verified = False
+            self.pin_retries -= 1
+            if self.pin_retries == 0:
+                return b"", SW_AUTH_BLOCKED
+            return b"", (0x63, 0xC0 | self.pin_retries)
+        self.pin_retries = 3
+        self.pin_verified = True
+        return b"", SW_OK
+
+    def reset(self):
+        if self.pin_retries or self.puk_retries:
+            return b"", SW_CONDITIONS
+        self.keys = {}
+        self.objects = {}
+        self.pin = DEFAULT_PIN.encode("ascii").ljust(8, b"\xff")
+        self.pin_retries = 3
+        self.puk_retries = 3
+        self.pin_verified = False
+        return b"", SW_OK
+
+
+class VirtualTransport:
+    """PIVcard transport to a VirtualPIVApplet, with simulated latency"""
+
+    settle_time = 0
+
+    def __init__(self, applet, latency=0.0, ins_latency=None):
+        # latency : seconds added to each APDU
+        # ins_latency : dict of INS byte to seconds, overrides latency
+        self.applet = applet
+        self.latency = latency
+        self.ins_latency = ins_latency or {}
+        self.connected = True
+        self.was_reset = False
+
+    def transmit(self, apdu):
+        if not self.connected:
+            raise ConnectionException("Virtual card removed")
+        if self.was_reset:
+            raise CardResetException("Virtual card was reset")
+        delay = self.ins_latency.get(apdu[1], self.latency)
+        if delay:
+            time.sleep(delay)
+        return self.applet.process(apdu)
+
+    def reconnect(self):
+        if not self.connected:
+            raise ConnectionException("Virtual card removed")
+        self.was_reset = False
+
+    def disconnect(self):
+        self.connected = False
+
+    def get_atr(self):
+        return self.applet.atr
+
+    def remove_card(self):
+        """Simulate the card removal"""
+        self.connected = False
+        self.applet.power_reset()
+
+    def reset_card(self):
+        """Simulate a card reset by another application"""
+        self.was_reset = True
+        self.applet.power_reset()
+
+    def select_other_applet(self):
+        """Simulate another application selecting another applet"""
+        self.applet.selected = False
@@ -88,7 +88,7 @@ def encode_openssh(pubkey_bytes, comment_text):
 
 
 def parse_sign_command(sign_cmd, debug):
-    """Parse sign query, and extract the data to sign"""
+    """Parse sign query, returns the key blob and the data to sign"""
     idseek = 0
     keyblob_len = read_len(sign_cmd)
     idseek += 4
@@ -103,7 +103,7 @@ def parse_sign_command(sign_cmd, debug):
         print("Data to sign :", data_tosign)
     if sign_cmd[idseek:] != b"\0\0\0\0":
         raise Exception("Unvalid signature query, must be compliant for ECC.")
-    return data_tosign
+    return key_blob, data_tosign
 
 
 def decode_sig(sig):
@@ -0,0 +1,394 @@
+"""SSH agent wire format codec, over memoryview and bytearray"""
+
+# Strings read are memoryview slices of the message, without copy.
+# RFC 4251 5. data types, draft-miller-ssh-agent messages,
+# RFC 4252 7. public key authentication data to sign.
+
+from struct import Struct, error as StructError
+
+SSH_AGENT_FAILURE = 5
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_SIGN_REQUEST = 13
+SSH_AGENT_SIGN_RESPONSE = 14
+
+SSH_MSG_USERAUTH_REQUEST = 50
+# Service, method and signature flag of a signed publickey authentication
+SIGNED_PUBLICKEY = b"\0\0\0\x0essh-connection\0\0\0\x09publickey\x01"
+
+# Sign request flags, only for RSA keys
+SSH_AGENT_RSA_SHA2_256 = 2
+SSH_AGENT_RSA_SHA2_512 = 4
+
+UINT32 = Struct(">I")
+# Message type and first string length
+MSG_HEADER = Struct(">BI")
+# Sign response header : type, signature length, key type length
+SIGN_HEADER = Struct(">BII")
+# Signature blob length and r length
+SIGN_BLOB_HEADER = Struct(">II")
+
+
+class WireError(ValueError):
+    """Malformed SSH wire data"""
+
+
+class WireReader:
+    """Bounds checked reading of SSH wire data types"""
+
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def truncated(self, length, what):
+        return WireError(
+            f"Truncated {what} : {length} bytes at offset {self.pos}, "
+            f"{len(self.data) - self.pos} left"
+        )
+
+    def take(self, length, what):
+        end = self.pos + length
+        if end > len(self.data):
+            raise self.truncated(length, what)
+        view = self.data[self.pos : end]
+        self.pos = end
+        return view
+
+    def uint8(self, what="byte"):
+        if self.pos >= len(self.data):
+            raise self.truncated(1, what)
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def boolean(self, what="boolean"):
+        return self.uint8(what) != 0
+
+    def uint32(self, what="uint32"):
+        if self.pos + 4 > len(self.data):
+            raise self.truncated(4, what)
+        self.pos += 4
+        return UINT32.unpack_from(self.data, self.pos - 4)[0]
+
+    def string(self, what="string"):
+        """String content, as a memoryview of the data"""
+        # Inlined, the most used read of the request path
+        data = self.data
+        start = self.pos + 4
+        if start > len(data):
+            raise self.truncated(4, what + " length")
+        end = start + UINT32.unpack_from(data, self.pos)[0]
+        if end > len(data):
+            self.pos = start
+            raise self.truncated(end - start, what)
+        self.pos = end
+        return data[start:end]
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def rest(self):
+        return self.take(self.remaining(), "rest")
+
+    def expect_end(self, what):
+        if self.pos != len(self.data):
+            raise WireError(f"{self.remaining()} extra bytes after {what}")
+
+
+class WireWriter:
+    """SSH wire data types writer in a bytearray
+
+    begin() and end() surround a string whose content is written
+    in place, its length is set at end.
+    """
+
+    __slots__ = ("buffer",)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def uint8(self, value):
+        self.buffer.append(value)
+        return self
+
+    def uint32(self, value):
+        self.buffer += value.to_bytes(4, "big")
+        return self
+
+    def string(self, data):
+        self.buffer += UINT32.pack(len(data))
+        self.buffer += data
+        return self
+
+    def raw(self, data):
+        self.buffer += data
+        return self
+
+    def begin(self):
+        """Start a string written in place, returns its mark for end"""
+        mark = len(self.buffer)
+        self.buffer += b"\0\0\0\0"
+        return mark
+
+    def end(self, mark):
+        length = len(self.buffer) - mark - 4
+        self.buffer[mark : mark + 4] = length.to_bytes(4, "big")
+        return self
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+class RequestIdentities:
+    """SSH_AGENTC_REQUEST_IDENTITIES"""
+
+    msg_type = SSH_AGENTC_REQUEST_IDENTITIES
+
+    @classmethod
+    def parse(cls, reader):
+        reader.expect_end("identities request")
+        return cls()
+
+    def encode(self):
+        return bytes((self.msg_type,))
+
+
+class SignRequest:
+    """SSH_AGENTC_SIGN_REQUEST, key_blob and data are memoryviews"""
+
+    msg_type = SSH_AGENTC_SIGN_REQUEST
+    __slots__ = ("key_blob", "data", "flags")
+
+    def __init__(self, key_blob, data, flags=0):
+        self.key_blob = key_blob
+        self.data = data
+        self.flags = flags
+
+    @classmethod
+    def parse(cls, reader):
+        # A well formed request is read at once, the reader methods
+        # are only used to report where a malformed one is wrong
+        data = reader.data
+        blob_start = reader.pos + 4
+        try:
+            data_start = blob_start + 4 + UINT32.unpack_from(data, reader.pos)[0]
+            flags_pos = data_start + UINT32.unpack_from(data, data_start - 4)[0]
+            flags = UINT32.unpack_from(data, flags_pos)[0]
+        except StructError:
+            flags_pos = len(data)
+        if flags_pos + 4 == len(data):
+            reader.pos = len(data)
+            return cls(
+                data[blob_start : data_start - 4], data[data_start:flags_pos], flags
+            )
+        key_blob = reader.string("sign request key blob")
+        data = reader.string("sign request data")
+        flags = reader.uint32("sign request flags")
+        reader.expect_end("sign request")
+        return cls(key_blob, data, flags)
+
+    def encode(self):
+        return b"".join(
+            (
+                MSG_HEADER.pack(self.msg_type, len(self.key_blob)),
+                self.key_blob,
+                UINT32.pack(len(self.data)),
+                self.data,
+                UINT32.pack(self.flags),
+            )
+        )
+
+
+class IdentitiesAnswer:
+    """SSH_AGENT_IDENTITIES_ANSWER, list of (key blob, comment bytes)"""
+
+    msg_type = SSH_AGENT_IDENTITIES_ANSWER
+    __slots__ = ("identities",)
+
+    def __init__(self, identities):
+        self.identities = identities
+
+    @classmethod
+    def parse(cls, reader):
+        nkeys = reader.uint32("identities count")
+        identities = [
+            (reader.string("identity key blob"), reader.string("identity comment"))
+            for _ in range(nkeys)
+        ]
+        reader.expect_end("identities answer")
+        return cls(identities)
+
+    def encode(self):
+        writer = WireWriter().uint8(self.msg_type).uint32(len(self.identities))
+        for key_blob, comment in self.identities:
+            writer.string(key_blob).string(comment)
+        return writer.getvalue()
+
+
+class SignResponse:
+    """SSH_AGENT_SIGN_RESPONSE of an ECDSA signature, RFC 5656 3.1.2"""
+
+    msg_type = SSH_AGENT_SIGN_RESPONSE
+    __slots__ = ("key_type", "r", "s")
+
+    def __init__(self, key_type, r, s):
+        # r and s as mpint content, from the DER integers
+        self.key_type = key_type
+        self.r = r
+        self.s = s
+
+    @classmethod
+    def from_der(cls, key_type, der_signature):
+        """From an ECDSA DER signature, SEQUENCE of 2 INTEGER"""
+        # Indexed as is, r and s are short copies of the card response
+        der = der_signature
+        if len(der) < 8 or der[0] != 0x30:
+            raise WireError("Wrong signature header")
+        # Short form sequence length up to P-384, a P-521 signature of
+        # 128 bytes or more has a 81 long form length
+        start = 2
+        seq_len = der[1]
+        if seq_len == 0x81 and der[2] >= 0x80:
+            start = 3
+            seq_len = der[2]
+        elif seq_len & 0x80:
+            raise WireError("Wrong signature length")
+        if seq_len != len(der) - start:
+            raise WireError("Wrong signature length")
+        # The integers have short form lengths
+        r_end = start + 2 + der[start + 1]
+        if der[start] != 0x02 or r_end + 2 > len(der) or der[r_end] != 0x02:
+            raise WireError("Wrong signature format")
+        if r_end + 2 + der[r_end + 1] != len(der):
+            raise WireError("Wrong signature length")
+        return cls(key_type, der[start + 2 : r_end], der[r_end + 2 :])
+
+    @classmethod
+    def parse(cls, reader):
+        sig_reader = WireReader(reader.string("signature"))
+        reader.expect_end("sign response")
+        key_type = sig_reader.string("signature key type")
+        blob_reader = WireReader(sig_reader.string("signature blob"))
+        sig_reader.expect_end("signature")
+        r = blob_reader.string("signature r")
+        s = blob_reader.string("signature s")
+        blob_reader.expect_end("signature blob")
+        return cls(key_type, r, s)
+
+    def encode(self):
+        # Lengths are known, packed in one pass
+        blob_len = 8 + len(self.r) + len(self.s)
+        sig_len = 8 + len(self.key_type) + blob_len
+        return b"".join(
+            (
+                SIGN_HEADER.pack(self.msg_type, sig_len, len(self.key_type)),
+                self.key_type,
+                SIGN_BLOB_HEADER.pack(blob_len, len(self.r)),
+                self.r,
+                UINT32.pack(len(self.s)),
+                self.s,
+            )
+        )
+
+
+class UserauthRequest:
+    """RFC 4252 7. publickey authentication data signed by the agent"""
+
+    __slots__ = ("session_id", "username", "algorithm", "key_blob")
+
+    def __init__(self, session_id, username, algorithm, key_blob):
+        self.session_id = session_id
+        self.username = username
+        self.algorithm = algorithm
+        self.key_blob = key_blob
+
+    @classmethod
+    def parse(cls, data):
+        data = memoryview(data)
+        # A well formed request is read at once, the reader methods
+        # are only used to report where a malformed one is wrong
+        try:
+            type_pos = 4 + UINT32.unpack_from(data, 0)[0]
+            user_end = type_pos + 5 + UINT32.unpack_from(data, type_pos + 1)[0]
+            algo_start = user_end + len(SIGNED_PUBLICKEY) + 4
+            blob_start = algo_start + 4 + UINT32.unpack_from(data, algo_start - 4)[0]
+            blob_end = blob_start + UINT32.unpack_from(data, blob_start - 4)[0]
+        except StructError:
+            blob_end = -1
+        if (
+            blob_end == len(data)
+            and data[type_pos] == SSH_MSG_USERAUTH_REQUEST
+            and data[user_end : algo_start - 4] == SIGNED_PUBLICKEY
+        ):
+            try:
+                username = str(data[type_pos + 5 : user_end], "utf8")
+            except UnicodeDecodeError as exc:
+                raise WireError("User name is not UTF-8") from exc
+            return cls(
+                data[4:type_pos],
+                username,
+                data[algo_start : blob_start - 4],
+                data[blob_start:],
+            )
+        reader = WireReader(data)
+        session_id = reader.string("session identifier")
+        if reader.uint8("message type") != SSH_MSG_USERAUTH_REQUEST:
+            raise WireError("Not a user authentication request")
+        username = reader.string("user name")
+        # Fixed encoding, checked at once
+        fields_pos = reader.pos
+        if reader.data[fields_pos : fields_pos + len(SIGNED_PUBLICKEY)] != (
+            SIGNED_PUBLICKEY
+        ):
+            reader.pos = fields_pos
+            raise signed_publickey_error(reader)
+        reader.pos += len(SIGNED_PUBLICKEY)
+        algorithm = reader.string("public key algorithm")
+        key_blob = reader.string("public key blob")
+        reader.expect_end("user authentication request")
+        try:
+            username = str(username, "utf8")
+        except UnicodeDecodeError as exc:
+            raise WireError("User name is not UTF-8") from exc
+        return cls(session_id, username, algorithm, key_blob)
+
+    def encode(self):
+        writer = WireWriter().string(self.session_id).uint8(SSH_MSG_USERAUTH_REQUEST)
+        writer.string(self.username.encode("utf8")).raw(SIGNED_PUBLICKEY)
+        return writer.string(self.algorithm).string(self.key_blob).getvalue()
+
+
+def signed_publickey_error(reader):
+    """Error of the fields not as in a signed publickey authentication"""
+    if reader.string("service name") != b"ssh-connection":
+        return WireError("Not a ssh-connection service authentication")
+    if reader.string("method name") != b"publickey":
+        return WireError("Not a publickey authentication")
+    if not reader.boolean("signature flag"):
+        return WireError("Not a signed authentication")
+    return WireError("Wrong publickey authentication encoding")
+
+
+MESSAGES = {
+    message.msg_type: message
+    for message in (
+        RequestIdentities,
+        SignRequest,
+        IdentitiesAnswer,
+        SignResponse,
+    )
+}
+
+
+def parse_message(message):
+    """Typed message of an agent message without its length header
+
+    Raises WireError for an unknown or malformed message.
+    """
+    reader = WireReader(message)
+    msg_type = reader.uint8("message type")
+    message_class = MESSAGES.get(msg_type)
+    if message_class is None:
+        raise WireError(f"Unsupported agent message type {msg_type}")
+    return message_class.parse(reader)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# PIVageant headless agent
+# the PIV dongle SSH agent, without window, for a service or a login script
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import logging
+import signal
+import sys
+from lib.piv.card_session import set_connection_mode
+from lib.piv.device_profiles import device_profiles, DEFAULT_PROFILES_FILE
+from lib.piv.keepalive import CardKeepalive
+from lib.agent.headless import HeadlessAgent
+from lib.agent.notifier import NOTIFIERS
+from lib.metrics import metrics, SnapshotWriter
+
+KEY_NAME = "ECPSSHKey"
+
+DEBUG_OUTPUT = False
+METRICS_FILE = ""
+NOTIFIER = "console"
+SOCKET_PATH = None
+KEEPALIVE = 0
+KEEPALIVE_MAX_IDLE = 3600
+PROFILES_FILE = DEFAULT_PROFILES_FILE
+
+
+def main():
+    if NOTIFIER not in NOTIFIERS:
+        sys.exit(f"Unknown notifier {NOTIFIER}, use {', '.join(NOTIFIERS)}")
+    if NOTIFIER == "log":
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s %(name)s %(message)s"
+        )
+    agent = HeadlessAgent(KEY_NAME, NOTIFIERS[NOTIFIER](), SOCKET_PATH, DEBUG_OUTPUT)
+    if sys.platform != "win32":
+        # As ssh-agent prints it
+        print(f"SSH_AUTH_SOCK={agent.socket_path}; export SSH_AUTH_SOCK;", flush=True)
+        # Stopped by a service manager as by Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if PROFILES_FILE:
+        device_profiles.load(PROFILES_FILE)
+    if KEEPALIVE:
+        CardKeepalive(KEEPALIVE, KEEPALIVE_MAX_IDLE, DEBUG_OUTPUT).start()
+    if METRICS_FILE:
+        metrics_writer = SnapshotWriter(metrics, METRICS_FILE)
+        metrics_writer.start()
+
+    try:
+        agent.run()
+    except OSError as exc:
+        # Another agent running, or its socket can't be created
+        sys.exit(f"PIVageant agent not started : {exc}")
+    finally:
+        if METRICS_FILE:
+            metrics_writer.stop()
+            metrics_writer.join()
+
+
+if __name__ == "__main__":
+    if "-v" in sys.argv[1:]:
+        DEBUG_OUTPUT = True
+    for arg in sys.argv[1:]:
+        if arg.startswith("--notify="):
+            NOTIFIER = arg[len("--notify=") :]
+        if arg.startswith("--socket="):
+            SOCKET_PATH = arg[len("--socket=") :]
+        if arg.startswith("--metrics="):
+            METRICS_FILE = arg[len("--metrics=") :]
+        if arg.startswith("--keepalive="):
+            KEEPALIVE = float(arg[len("--keepalive=") :])
+        if arg.startswith("--keepalive-max-idle="):
+            KEEPALIVE_MAX_IDLE = float(arg[len("--keepalive-max-idle=") :])
+    if "--no-profiles" in sys.argv[1:]:
+        PROFILES_FILE = ""
+    if "--exclusive" in sys.argv[1:]:
+        set_connection_mode(share_mode="exclusive")
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# PIVageant : card layer tests over the virtual PIV device
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from lib.metrics import metrics
+from lib.piv.card_session import PIVSession
+from lib.piv.piv_card import PIVcard, CardResetException, ALG_3DES, ALG_ECP256
+from lib.piv.virtual_card import (
+    VirtualPIVApplet,
+    VirtualTransport,
+    DEFAULT_ADMIN_KEY,
+    TOUCH_NEVER,
+    PIN_NEVER,
+)
+
+
+class RecordingTransport(VirtualTransport):
+    """Virtual transport keeping the APDUs sent"""
+
+    def __init__(self, applet):
+        super().__init__(applet)
+        self.apdus = []
+
+    def transmit(self, apdu):
+        self.apdus.append(bytes(apdu))
+        return super().transmit(apdu)
+
+
+def sign_applet():
+    """Virtual device with a key signing without PIN nor touch in 9A"""
+    applet = VirtualPIVApplet()
+    applet.import_key(0x9A, ALG_ECP256, None, TOUCH_NEVER)
+    applet.keys[0x9A].pin_policy = PIN_NEVER
+    return applet
+
+
+def sign(card):
+    return card.sign_ec(ALG_ECP256, 0x9A, b"data to sign")
+
+
+def check_signature(applet, signature):
+    public_key = applet.keys[0x9A].private_key.public_key()
+    public_key.verify(signature, b"data to sign", ec.ECDSA(hashes.SHA256()))
+
+
+def test_extended_length_fallback_to_chaining():
+    applet = VirtualPIVApplet(extended_length=False)
+    transport = RecordingTransport(applet)
+    card = PIVcard(1, transport=transport)
+    # Yubikey 5 version, extended length assumed
+    assert card.extended_length
+    transport.apdus.clear()
+    card.external_auth_admin(0x9B, ALG_3DES, bytes.fromhex(DEFAULT_ADMIN_KEY))
+    # Rejected extended APDU, sent again as a short APDU
+    assert transport.apdus[0][4] == 0
+    assert transport.apdus[1][4] != 0
+    assert not card.extended_length
+    certificate = bytes(range(256)) * 3
+    transport.apdus.clear()
+    card.put_data("5FC101", certificate)
+    assert len(transport.apdus) == 4
+    assert all(apdu[0] & 0x10 for apdu in transport.apdus[:-1])
+    assert not transport.apdus[-1][0] & 0x10
+    assert all(len(apdu) <= 5 + 255 for apdu in transport.apdus)
+    # Response longer than 256 bytes, with GET RESPONSE
+    card.invalidate_data("5FC101")
+    assert card.get_data("5FC101") == certificate
+
+
+def test_extended_length_single_apdu():
+    applet = VirtualPIVApplet()
+    transport = RecordingTransport(applet)
+    card = PIVcard(1, transport=transport)
+    card.external_auth_admin(0x9B, ALG_3DES, bytes.fromhex(DEFAULT_ADMIN_KEY))
+    transport.apdus.clear()
+    card.put_data("5FC101", bytes(700))
+    assert len(transport.apdus) == 1
+    assert card.extended_length
+
+
+def counter(name):
+    return metrics.snapshot()["counters"].get(name, 0)
+
+
+def test_session_recovers_from_reset():
+    applet = sign_applet()
+    transport = VirtualTransport(applet)
+    session = PIVSession(transport_factory=lambda timeout: transport)
+    check_signature(applet, session.run(1, sign))
+    resets = counter("card_resets")
+    transport.reset_card()
+    check_signature(applet, session.run(1, sign))
+    assert counter("card_resets") == resets + 1
+    assert session.card.transport is transport
+
+
+def test_session_selects_applet_again():
+    applet = sign_applet()
+    transport = VirtualTransport(applet)
+    session = PIVSession(transport_factory=lambda timeout: transport)
+    session.run(1, sign)
+    reselects = counter("applet_reselects")
+    transport.select_other_applet()
+    check_signature(applet, session.run(1, sign))
+    assert counter("applet_reselects") == reselects + 1
+
+
+def test_session_reconnects_after_removal():
+    applet = sign_applet()
+    transports = []
+
+    def connect(timeout):
+        transports.append(VirtualTransport(applet))
+        return transports[-1]
+
+    session = PIVSession(transport_factory=connect)
+    session.run(1, sign)
+    transports[0].remove_card()
+    check_signature(applet, session.run(1, sign))
+    assert len(transports) == 2
+    assert session.card.transport is transports[1]
+
+
+def test_session_recovers_only_once():
+    applet = sign_applet()
+    transport = VirtualTransport(applet)
+    session = PIVSession(transport_factory=lambda timeout: transport)
+    session.run(1, sign)
+
+    def reset_and_sign(card):
+        transport.reset_card()
+        return sign(card)
+
+    with pytest.raises(CardResetException):
+        session.run(1, reset_and_sign)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# PIVageant : sign requests scheduler tests
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+from threading import Event
+from time import sleep
+import pytest
+from lib.agent.scheduler import SignScheduler
+
+FAILURE = b"failure"
+
+
+class BlockingCard:
+    """process() of a card, blocking on "block" until released"""
+
+    def __init__(self):
+        self.processed = []
+        self.started = Event()
+        self.release = Event()
+
+    def process(self, message):
+        if message == b"block":
+            self.started.set()
+            assert self.release.wait(5)
+        self.processed.append(message)
+        return b"reply " + message
+
+
+@pytest.fixture
+def card():
+    return BlockingCard()
+
+
+def busy_scheduler(card, **options):
+    """Scheduler with its worker busy on a first request"""
+    scheduler = SignScheduler(card.process, FAILURE, **options)
+    first = scheduler.submit(b"block")
+    assert card.started.wait(5)
+    return scheduler, first
+
+
+def test_reply(card):
+    scheduler = SignScheduler(card.process, FAILURE)
+    assert scheduler.submit(b"one").result(5) == b"reply one"
+    scheduler.close()
+
+
+def test_cancelled_never_processed(card):
+    scheduler, first = busy_scheduler(card)
+    cancelled = scheduler.submit(b"cancelled")
+    kept = scheduler.submit(b"kept")
+    assert cancelled.cancel()
+    card.release.set()
+    assert kept.result(5) == b"reply kept"
+    assert first.result(5) == b"reply block"
+    assert card.processed == [b"block", b"kept"]
+    scheduler.close()
+
+
+def test_expired_never_processed(card):
+    scheduler, first = busy_scheduler(card, timeout=0.05)
+    expired = scheduler.submit(b"expired")
+    sleep(0.1)
+    card.release.set()
+    assert expired.result(5) == FAILURE
+    assert card.processed == [b"block"]
+    # Within the timeout once the card is free
+    assert scheduler.submit(b"in time").result(5) == b"reply in time"
+    scheduler.close()
+
+
+def test_queue_full(card):
+    scheduler, first = busy_scheduler(card, max_depth=2)
+    waiting = [scheduler.submit(b"%i" % index) for index in range(2)]
+    rejected = scheduler.submit(b"rejected")
+    assert rejected.done() and rejected.result() == FAILURE
+    card.release.set()
+    assert [future.result(5) for future in waiting] == [b"reply 0", b"reply 1"]
+    scheduler.close()
+
+
+def test_round_robin(card):
+    scheduler, first = busy_scheduler(card)
+    futures = [scheduler.submit(b"a%i" % index, "a") for index in range(3)]
+    futures.append(scheduler.submit(b"b0", "b"))
+    card.release.set()
+    for future in futures:
+        future.result(5)
+    assert card.processed == [b"block", b"a0", b"b0", b"a1", b"a2"]
+    scheduler.close()
+
+
+def test_close_cancels_waiting(card):
+    scheduler, first = busy_scheduler(card)
+    waiting = scheduler.submit(b"waiting")
+    scheduler.close()
+    card.release.set()
+    assert waiting.cancelled()
+    assert first.result(5) == b"reply block"
+    assert scheduler.submit(b"closed").result() == FAILURE
+    scheduler.worker.join(5)
+    assert card.processed == [b"block"]
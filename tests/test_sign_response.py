@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# PIVageant : ECDSA DER signature to SSH agent sign response tests
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from lib.ssh.wire import SignResponse, WireError, WireReader
+
+
+def mpint_value(content):
+    # mpint content : big endian, a leading 00 only before a high bit set
+    assert not content[0] & 0x80
+    assert content[0] or content[1] & 0x80
+    return int.from_bytes(content, "big")
+
+
+@pytest.mark.parametrize(
+    "curve, key_type",
+    [
+        (ec.SECP256R1(), b"ecdsa-sha2-nistp256"),
+        (ec.SECP384R1(), b"ecdsa-sha2-nistp384"),
+        (ec.SECP521R1(), b"ecdsa-sha2-nistp521"),
+    ],
+)
+def test_from_der(curve, key_type):
+    private_key = ec.generate_private_key(curve)
+    for index in range(16):
+        der = private_key.sign(b"%i" % index, ec.ECDSA(hashes.SHA256()))
+        r, s = utils.decode_dss_signature(der)
+        response = SignResponse.from_der(key_type, der)
+        assert (mpint_value(response.r), mpint_value(response.s)) == (r, s)
+        encoded = response.encode()
+        reader = WireReader(encoded)
+        assert reader.uint8() == SignResponse.msg_type
+        parsed = SignResponse.parse(reader)
+        assert parsed.key_type == key_type
+        assert (mpint_value(parsed.r), mpint_value(parsed.s)) == (r, s)
+
+
+def test_p521_long_form_length():
+    # 2 integers of 66 bytes, the sequence length needs the 81 form
+    r = s = b"\x01" + bytes(65)
+    content = b"\x02\x42" + r + b"\x02\x42" + s
+    der = b"\x30\x81" + bytes((len(content),)) + content
+    response = SignResponse.from_der(b"ecdsa-sha2-nistp521", der)
+    assert (bytes(response.r), bytes(response.s)) == (r, s)
+
+
+@pytest.mark.parametrize(
+    "der",
+    [
+        b"\x31\x06\x02\x01\x01\x02\x01\x01",
+        b"\x30\x07\x02\x01\x01\x02\x01\x01",
+        b"\x30\x81\x06\x02\x01\x01\x02\x01\x01",
+        b"\x30\x82\x00\x06\x02\x01\x01\x02\x01\x01",
+        b"\x30\x06\x04\x01\x01\x02\x01\x01",
+        b"\x30\x06\x02\x02\x01\x02\x01\x01",
+        b"\x30\x06\x02\x01\x01\x02\x01\x01\x00",
+        b"\x30\x02\x02\x00",
+    ],
+)
+def test_from_der_malformed(der):
+    with pytest.raises(WireError):
+        SignResponse.from_der(b"ecdsa-sha2-nistp256", der)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# PIVageant : BER-TLV reader tests
+# Copyright (C) 2021-2022  BitLogiK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import pytest
+from lib.piv.piv_card import TLV, DataException, encode_do
+
+
+def test_nested_find():
+    signature = bytes(range(70))
+    response = b"\x7C" + encode_do(b"\x82" + encode_do(signature))
+    assert bytes(TLV(response).find(0x7C, 0x82)) == signature
+    assert TLV(response).find(0x7C, 0x81) is None
+
+
+def test_long_form_lengths():
+    for size in (0x7F, 0x80, 0xFF, 0x100, 0x1234):
+        content = bytes(size)
+        tlv = TLV(b"\x53" + encode_do(content) + b"\x01\x01\xAA")
+        assert bytes(tlv[0x53]) == content
+        assert bytes(tlv[0x01]) == b"\xAA"
+
+
+def test_multi_bytes_tag():
+    tlv = TLV(b"\x5F\xC1\x05\x02\xAB\xCD\x80\x00")
+    assert bytes(tlv[0x5FC105]) == b"\xAB\xCD"
+    assert bytes(tlv[0x80]) == b""
+    assert [tag for tag, _ in tlv] == [0x5FC105, 0x80]
+
+
+def test_get_all_and_missing():
+    tlv = TLV(b"\x80\x01\x11\x81\x00\x80\x01\x14")
+    assert [bytes(value) for value in tlv.get_all(0x80)] == [b"\x11", b"\x14"]
+    assert 0x81 in tlv
+    assert 0x82 not in tlv
+    assert tlv.get(0x82, b"") == b""
+    with pytest.raises(KeyError):
+        tlv[0x82]
+
+
+def test_values_are_views():
+    data = bytearray(b"\x53\x03abc")
+    value = TLV(data)[0x53]
+    assert isinstance(value, memoryview)
+    data[2] = ord("x")
+    assert bytes(value) == b"xbc"
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"\x53\x05abc",
+        b"\x53\x82\x01",
+        b"\x53\x82\x01\x00abc",
+        b"\x53\x80",
+        b"\x53\x85\x00\x00\x00\x00\x01a",
+        b"\x5F\xC1",
+        b"\x5F",
+        b"\x53",
+    ],
+)
+def test_malformed(data):
+    with pytest.raises(DataException):
+        TLV(data).get(0x01)